@@ -0,0 +1,58 @@
+"""Helpers shared by the offline benchmarks."""
+
+from __future__ import annotations
+
+import time
+from types import SimpleNamespace
+from typing import Any, Callable
+
+
+class StubLoop:
+    def create_task(self, coro):
+        # Background tasks need a real bot, the benchmarks fill in whatever they need themselves
+        coro.close()
+
+    def call_later(self, delay, callback, *args):
+        return SimpleNamespace(cancel=lambda: None)
+
+
+class StubBot:
+    def __init__(self):
+        self.loop = StubLoop()
+        self.owner_id = 0
+
+
+def summarise(name: str, samples: list[int], count: int) -> dict[str, Any]:
+    # samples are nanoseconds per call
+    ordered = sorted(samples)
+    total = sum(ordered) / 1e9
+    return {
+        'name': name,
+        'calls': count,
+        'per_second': count / total if total else float('inf'),
+        'p50_us': ordered[len(ordered) // 2] / 1e3,
+        'p99_us': ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] / 1e3,
+    }
+
+
+def time_calls(func: Callable[[Any], Any], inputs: list[Any]) -> list[int]:
+    samples = []
+    for item in inputs:
+        start = time.perf_counter_ns()
+        func(item)
+        samples.append(time.perf_counter_ns() - start)
+    return samples
+
+
+def report(data: dict[str, Any], baseline: dict[str, Any] | None) -> None:
+    old = {r['name']: r for r in baseline['results']} if baseline else {}
+    header = f'{"benchmark":<20} {"ops/s":>12} {"p50 (us)":>10} {"p99 (us)":>10}'
+    if old:
+        header += f' {"vs baseline":>12}'
+    print(header)
+    for result in data['results']:
+        line = f'{result["name"]:<20} {result["per_second"]:>12.0f} {result["p50_us"]:>10.1f} {result["p99_us"]:>10.1f}'
+        previous = old.get(result['name'])
+        if previous:
+            line += f' {result["per_second"] / previous["per_second"]:>11.2f}x'
+        print(line)
@@ -0,0 +1,190 @@
+"""
+Offline benchmarks for the highlight pipeline.
+
+Builds synthetic guilds out of stubbed discord objects and drives the Highlights cog with them,
+no connection to discord or the database is needed.
+
+Usage:
+    python -m benchmarks.highlight
+    python -m benchmarks.highlight --subscribers 2000 --words 10 --save benchmarks/highlight_baseline.json
+    python -m benchmarks.highlight --compare benchmarks/highlight_baseline.json
+"""
+
+from __future__ import annotations
+
+import gc
+import json
+import time
+import random
+import string
+import asyncio
+import argparse
+import tracemalloc
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+import discord
+
+from benchmarks.common import StubBot, report, summarise, time_calls
+from cogs.highlight import Highlights, HighlightMatcher, IgnoreList
+
+
+class StubUser:
+    __slots__ = ('id', 'name', 'global_name', 'bot', 'discriminator')
+
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.name = f'user{user_id}'
+        self.global_name = f'User {user_id}'
+        self.bot = False
+        self.discriminator = '0'
+
+    def __str__(self) -> str:
+        return self.name
+
+
+def make_words(rng: random.Random, count: int) -> list[str]:
+    words = set()
+    while len(words) < count:
+        words.add(''.join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9))))
+    return list(words)
+
+
+def build_cog(args: argparse.Namespace, rng: random.Random) -> tuple[Highlights, SimpleNamespace, list[str], list[int]]:
+    cog = Highlights(StubBot())
+    guild = SimpleNamespace(id=1)
+    vocabulary = make_words(rng, args.vocabulary)
+
+    subscribers = list(range(1000, 1000 + args.subscribers))
+    matcher = HighlightMatcher()
+    for user_id in subscribers:
+        matcher.set_user(user_id, rng.sample(vocabulary, args.words))
+    cog.highlights[guild.id] = matcher
+
+    channels = list(range(10, 10 + args.channels))
+    for user_id in rng.sample(subscribers, int(len(subscribers) * args.ignoring)):
+        cog.ignores[user_id] = IgnoreList(
+            users=frozenset(rng.sample(subscribers, args.ignores)),
+            channels=frozenset(rng.sample(channels, min(args.ignores, len(channels)))),
+        )
+
+    return cog, guild, vocabulary, channels
+
+
+def make_corpus(args: argparse.Namespace, rng: random.Random, guild: SimpleNamespace, vocabulary: list[str], channels: list[int]) -> list[SimpleNamespace]:
+    # Most of the corpus is filler so only some messages trigger highlights, like a real channel
+    filler = make_words(rng, 500)
+    authors = [StubUser(user_id) for user_id in range(1, 200)]
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    corpus = []
+    for i in range(args.messages):
+        words = [rng.choice(vocabulary) if rng.random() < args.hit_rate else rng.choice(filler) for _ in range(rng.randint(3, 30))]
+        corpus.append(SimpleNamespace(
+            id=i,
+            guild=guild,
+            channel=SimpleNamespace(id=rng.choice(channels)),
+            author=rng.choice(authors),
+            content=' '.join(words),
+            created_at=start + timedelta(seconds=i),
+            webhook_id=None,
+            type=discord.MessageType.default,
+            reference=None,
+            attachments=[],
+        ))
+    return corpus
+
+
+async def bench_on_message(cog: Highlights, corpus: list[SimpleNamespace]) -> tuple[list[int], int]:
+    triggered = 0
+
+    async def record(message, highlights):
+        nonlocal triggered
+        triggered += len(highlights)
+
+    # Everything after matching waits on discord, so only the matching part is measured
+    cog.handle_highlights = record  # type: ignore
+    samples = []
+    for message in corpus:
+        start = time.perf_counter_ns()
+        await cog.on_message(message)
+        samples.append(time.perf_counter_ns() - start)
+    return samples, triggered
+
+
+def run(args: argparse.Namespace) -> dict[str, Any]:
+    rng = random.Random(args.seed)
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    cog, guild, vocabulary, channels = build_cog(args, rng)
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    corpus = make_corpus(args, rng, guild, vocabulary, channels)
+    results = []
+
+    samples, triggered = asyncio.run(bench_on_message(cog, corpus))
+    results.append(summarise('on_message', samples, len(corpus)))
+
+    # The old per-user regex loop, kept as a reference point for the matcher
+    regexes = {user_id: cog.create_user_regex(list(words)) for user_id, words in cog.highlights[guild.id]._users.items()}
+    samples = time_calls(lambda m: [r.search(m.content) for r in regexes.values()], corpus[:max(1, len(corpus) // 10)])
+    results.append(summarise('per_user_regex', samples, len(samples)))
+
+    word_lists = [rng.sample(vocabulary, args.words) for _ in range(1000)]
+    samples = time_calls(cog.create_user_regex, word_lists)
+    results.append(summarise('create_user_regex', samples, len(samples)))
+
+    checks = [(rng.randrange(1000, 1000 + args.subscribers), message) for message in corpus]
+    samples = time_calls(lambda pair: cog.should_ignore(*pair), checks)
+    results.append(summarise('should_ignore', samples, len(samples)))
+
+    samples = time_calls(lambda m: cog.format_message(m, bold=True, word=m.content.split()[0]), corpus)
+    results.append(summarise('format_message', samples, len(samples)))
+
+    contexts = [(corpus[max(0, i - 4):i + 1], corpus[i + 1:i + 4]) for i in range(len(corpus))]
+    samples = time_calls(lambda pair: cog.build_full_context(pair[0], pair[1], pair[0][-1].content.split()[0]), contexts)
+    results.append(summarise('build_full_context', samples, len(samples)))
+
+    return {
+        'config': {k: v for k, v in vars(args).items() if k not in ('save', 'compare')},
+        'memory_per_subscriber': memory / max(1, args.subscribers),
+        'triggers_per_message': triggered / max(1, len(corpus)),
+        'results': results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the highlight pipeline against synthetic guilds')
+    parser.add_argument('--subscribers', type=int, default=500, help='highlight users in the guild')
+    parser.add_argument('--words', type=int, default=5, help='triggers per user')
+    parser.add_argument('--vocabulary', type=int, default=2000, help='distinct trigger words to pick from')
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--ignoring', type=float, default=0.2, help='fraction of users with ignore lists')
+    parser.add_argument('--ignores', type=int, default=20, help='entries per ignore list')
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--hit-rate', type=float, default=0.02, help='chance a word in a message is a trigger')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='compare the results with a previously saved file')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    data = run(args)
+    print(f'Memory per subscriber: {data["memory_per_subscriber"]:.0f} bytes')
+    print(f'Highlights triggered per message: {data["triggers_per_message"]:.2f}')
+    report(data, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(data, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Microbenchmark for utils.time.human_timedelta.
+
+Compares it against the relativedelta implementation it falls back to, after checking both produce
+the same strings for a fuzzed set of inputs.
+
+Usage:
+    python -m benchmarks.human_timedelta
+    python -m benchmarks.human_timedelta --save benchmarks/human_timedelta_baseline.json
+    python -m benchmarks.human_timedelta --compare benchmarks/human_timedelta_baseline.json
+"""
+
+from __future__ import annotations
+
+import sys
+import json
+import random
+import argparse
+import datetime
+import zoneinfo
+from typing import Any
+
+from benchmarks.common import report, summarise, time_calls
+from utils import time
+
+
+ZONES = (datetime.timezone.utc, zoneinfo.ZoneInfo('America/New_York'), zoneinfo.ZoneInfo('Asia/Kolkata'))
+FLAGS = [
+    {},
+    {'accuracy': 1},
+    {'accuracy': 2, 'brief': True},
+    {'accuracy': None},
+    {'brief': True, 'suffix': False},
+]
+
+
+def relativedelta_only(dt: datetime.datetime, now: datetime.datetime, accuracy: int | None = 3,
+                       brief: bool = False, suffix: bool = True) -> str:
+    """human_timedelta without the fast path, the way it was before"""
+    now = now.replace(microsecond=0).astimezone(datetime.timezone.utc)
+    dt = dt.replace(microsecond=0).astimezone(datetime.timezone.utc)
+    return time._human_relativedelta(dt, now, accuracy, brief, suffix)
+
+
+def make_inputs(rng: random.Random, count: int, max_days: int) -> list[tuple[datetime.datetime, datetime.datetime, dict[str, Any]]]:
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    inputs = []
+    for _ in range(count):
+        now = start + datetime.timedelta(seconds=rng.randrange(2 * 365 * 86400), microseconds=rng.randrange(10**6))
+        # Mostly near deltas like reminder lists and join embeds, with some far away ones
+        span = rng.choice((60, 3600, 86400, 7 * 86400, max_days * 86400))
+        dt = now + datetime.timedelta(seconds=rng.randint(-span, span), microseconds=rng.randrange(10**6))
+        inputs.append((dt.astimezone(rng.choice(ZONES)), now.astimezone(rng.choice(ZONES)), rng.choice(FLAGS)))
+    return inputs
+
+
+def run(args: argparse.Namespace) -> dict[str, Any]:
+    rng = random.Random(args.seed)
+    inputs = make_inputs(rng, args.inputs, args.max_days)
+
+    mismatches = []
+    for dt, now, flags in make_inputs(rng, args.fuzz, args.max_days):
+        expected = relativedelta_only(dt, now, **flags)
+        got = time.human_timedelta(dt, source=now, **flags)
+        if expected != got:
+            mismatches.append(f'{dt.isoformat()} from {now.isoformat()} {flags}: expected {expected!r}, got {got!r}')
+
+    results = []
+    samples = time_calls(lambda args: relativedelta_only(args[0], args[1], **args[2]), inputs)
+    results.append(summarise('relativedelta', samples, len(samples)))
+
+    time._human_seconds.cache_clear()
+    samples = time_calls(lambda args: time.human_timedelta(args[0], source=args[1], **args[2]), inputs)
+    results.append(summarise('human_timedelta', samples, len(samples)))
+
+    return {
+        'config': {k: v for k, v in vars(args).items() if k not in ('save', 'compare')},
+        'mismatches': mismatches,
+        'results': results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark human_timedelta against the relativedelta implementation')
+    parser.add_argument('--inputs', type=int, default=20000, help='calls to time')
+    parser.add_argument('--fuzz', type=int, default=200000, help='random inputs to compare the output of')
+    parser.add_argument('--max-days', type=int, default=800, help='furthest apart the two times can be')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='compare the results with a previously saved file')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    data = run(args)
+    report(data, baseline)
+    for mismatch in data['mismatches'][:20]:
+        print(mismatch)
+    print(f'{len(data["mismatches"])} outputs differ from relativedelta')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    if data['mismatches']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Offline benchmarks for the natural language time parsing in UserFriendlyTime.
+
+Runs a corpus of reminder phrasings through parse_natural_time and parsedatetime's nlp,
+checking that both agree before comparing how long they take.
+
+Usage:
+    python -m benchmarks.time_parsing
+    python -m benchmarks.time_parsing --save benchmarks/time_parsing_baseline.json
+    python -m benchmarks.time_parsing --compare benchmarks/time_parsing_baseline.json
+"""
+
+from __future__ import annotations
+
+import sys
+import json
+import random
+import argparse
+import datetime
+import zoneinfo
+from typing import Any
+
+from benchmarks.common import report, summarise, time_calls
+from utils import time
+
+
+CORPUS = (
+    'in 10 minutes check the oven',
+    'in 5 mins stand up',
+    'in 1 min test',
+    'in 30 minutes call mom',
+    'in 2 hours take the laundry out',
+    'in 1 hour meeting with sam',
+    'in 3 days pay rent',
+    'in 1 day renew library books',
+    'in 2 weeks dentist appointment',
+    'in 1 week follow up with recruiter',
+    'IN 3 DAYS submit report',
+    'tomorrow at 5pm go to the gym',
+    'tomorrow at 9am standup',
+    'tomorrow at 12pm lunch with alex',
+    'tomorrow at 10:30am doctor',
+    'tomorrow at 7 pm dinner reservation',
+    'Tomorrow at 8AM water plants',
+    'next monday start the new project',
+    'next tuesday trash day',
+    'next wednesday book flights',
+    'next thursday review pull requests',
+    'next friday pay day',
+    'next saturday farmers market',
+    'next sunday call grandma',
+    '2025-01-15 renew passport',
+    '2024-12-24 wrap presents',
+    '2025-03-01 taxes',
+    'tomorrow check the mail',
+    'tonight watch the game',
+    'at 5pm leave work',
+    'at 11:30 submit form',
+    'friday clean the kitchen',
+    'on monday at 9am send invoices',
+    'this weekend fix the bike',
+    'next week plan the trip',
+    'in a month cancel subscription',
+    'in 6 months check the car',
+    'in a year anniversary',
+    'noon tomorrow pick up package',
+    'midnight release goes live',
+    'may 5th birthday party',
+    'june 1 at 3pm graduation',
+    'in 3 days at 5pm pick up the car',
+    'in 2 hours and 30 minutes pizza',
+    'end of month invoices',
+    'eod push the fix',
+    '"tomorrow at 6pm" quoted reminder',
+    'remind me about the meeting at 4pm',
+    'take out the trash tomorrow',
+    'buy milk in 20 minutes',
+    'call back in 3 hours',
+    'next year new glasses',
+    'december 25 christmas',
+    'this friday at 6pm drinks',
+    'in 45 minutes stretch',
+    'in 90 minutes end of the movie',
+    'in 4 days return the package',
+    'tomorrow evening call dad',
+    'sunday morning run',
+    '3 days from now check email',
+)
+
+ZONES = ('America/New_York', 'Europe/London', 'Asia/Kolkata', 'Australia/Sydney')
+
+
+def make_inputs(rng: random.Random, count: int) -> list[tuple[str, datetime.datetime]]:
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    inputs = []
+    for _ in range(count):
+        now = start + datetime.timedelta(seconds=rng.randrange(2 * 365 * 86400), microseconds=rng.randrange(10**6))
+        inputs.append((rng.choice(CORPUS), now.astimezone(zoneinfo.ZoneInfo(rng.choice(ZONES)))))
+    return inputs
+
+
+def nlp(argument: str, now: datetime.datetime) -> Any:
+    return time.HumanTime.calendar.nlp(argument, sourceTime=now)
+
+
+def first_element(elements: Any) -> Any:
+    # The status objects don't compare by value, their accuracy is what UserFriendlyTime reads
+    if not elements:
+        return None
+    dt, status, begin, end, _ = elements[0]
+    return dt, status.accuracy, begin, end
+
+
+def check_agreement(inputs: list[tuple[str, datetime.datetime]]) -> list[str]:
+    mismatches = []
+    for argument, now in inputs:
+        # Also parse a few seconds later in the same minute to go through the cache
+        for later in (now, now.replace(second=min(59, now.second + 7))):
+            expected = first_element(nlp(argument, later))
+            got = first_element(time.parse_natural_time(argument, later))
+            if expected != got:
+                mismatches.append(f'{argument!r} at {later.isoformat()}: expected {expected}, got {got}')
+    return mismatches
+
+
+def run(args: argparse.Namespace) -> dict[str, Any]:
+    rng = random.Random(args.seed)
+    inputs = make_inputs(rng, args.inputs)
+
+    # Warm parsedatetime up so the first call's setup isn't counted
+    nlp(CORPUS[0], inputs[0][1])
+    results = []
+
+    samples = time_calls(lambda pair: nlp(*pair), inputs)
+    results.append(summarise('nlp', samples, len(samples)))
+
+    time._nlp_cache.clear()
+    samples = time_calls(lambda pair: time.parse_natural_time(*pair), inputs)
+    results.append(summarise('parse_cold', samples, len(samples)))
+
+    # The most recent phrases again a few seconds later, like a retried or edited command
+    later = [(argument, now.replace(second=min(59, now.second + 3))) for argument, now in inputs[-256:]]
+    samples = time_calls(lambda pair: time.parse_natural_time(*pair), later)
+    results.append(summarise('parse_cached', samples, len(samples)))
+
+    time._nlp_cache.clear()
+    mismatches = check_agreement(inputs)
+
+    return {
+        'config': {k: v for k, v in vars(args).items() if k not in ('save', 'compare')},
+        'mismatches': mismatches,
+        'results': results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the natural language time parsing')
+    parser.add_argument('--inputs', type=int, default=2000, help='phrases to parse, picked from the corpus')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='compare the results with a previously saved file')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    data = run(args)
+    report(data, baseline)
+    for mismatch in data['mismatches'][:20]:
+        print(mismatch)
+    print(f'{len(data["mismatches"])} results differ from nlp')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    if data['mismatches']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
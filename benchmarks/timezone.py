@@ -0,0 +1,106 @@
+"""
+Offline benchmarks for the timezone search used by autocomplete.
+
+Replays queries the way they arrive from autocomplete, one keystroke at a time, against the Timezone cog.
+The CLDR aliases come from the local snapshot when there is one, otherwise they are made up from the IANA names.
+
+Usage:
+    python -m benchmarks.timezone
+    python -m benchmarks.timezone --save benchmarks/timezone_baseline.json
+    python -m benchmarks.timezone --compare benchmarks/timezone_baseline.json
+"""
+
+from __future__ import annotations
+
+import json
+import random
+import argparse
+from typing import Any
+
+from benchmarks.common import StubBot, report, summarise, time_calls
+from cogs.timezone import Timezone
+
+
+def synthetic_aliases(timezone: Timezone) -> dict[str, str]:
+    # Roughly the shape of the CLDR descriptions, "City, Region"
+    aliases = {}
+    for key in timezone.valid_timezones:
+        region, _, city = key.rpartition('/')
+        if region:
+            aliases[f'{city.replace("_", " ")}, {region.replace("/", " ")}'] = key
+    return aliases
+
+
+def make_queries(rng: random.Random, labels: list[str], count: int, typo_rate: float) -> list[str]:
+    queries = []
+    for label in rng.sample(labels, min(count, len(labels))):
+        word = label.split(',')[0]
+        if rng.random() < typo_rate and len(word) > 3:
+            i = rng.randrange(1, len(word) - 1)
+            word = word[:i] + word[i + 1] + word[i] + word[i + 2:]
+        # Autocomplete fires for every character typed
+        queries.extend(word[:end] for end in range(1, len(word) + 1))
+    return queries
+
+
+def run(args: argparse.Namespace) -> dict[str, Any]:
+    rng = random.Random(args.seed)
+    timezone = Timezone(StubBot())  # type: ignore
+    timezone.load_cldr_snapshot()
+    if not timezone._default_timezones:
+        timezone.swap_cldr_timezones(synthetic_aliases(timezone), [])
+
+    labels = list(timezone._timezone_aliases)
+    queries = make_queries(rng, labels, args.queries, args.typo_rate)
+    identifiers = [q for key in rng.sample(sorted(k for k in timezone.valid_timezones if '/' in k), args.queries)
+                   for q in (key[:end] for end in range(key.index('/') + 1, len(key) + 1))]
+    results = []
+
+    # Fresh indexes so nothing is cached yet, the way the first user typing a name sees it
+    timezone.swap_cldr_timezones({k: v for k, v in timezone._timezone_aliases.items()}, [])
+    samples = time_calls(timezone.find_timezones, queries)
+    results.append(summarise('alias_cold', samples, len(samples)))
+
+    samples = time_calls(timezone.find_timezones, queries)
+    results.append(summarise('alias_cached', samples, len(samples)))
+
+    samples = time_calls(timezone.find_timezones, identifiers)
+    results.append(summarise('identifier_cold', samples, len(samples)))
+
+    # The previous approach, a substring scan over every label per keystroke
+    lowered = [(label.lower(), label) for label in labels]
+    samples = time_calls(lambda q: [label for low, label in lowered if q.lower() in low], queries)
+    results.append(summarise('linear_scan', samples, len(samples)))
+
+    return {
+        'config': {k: v for k, v in vars(args).items() if k not in ('save', 'compare')},
+        'aliases': len(labels),
+        'results': results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the timezone search used by autocomplete')
+    parser.add_argument('--queries', type=int, default=200, help='names to type out one character at a time')
+    parser.add_argument('--typo-rate', type=float, default=0.2, help='chance a name is typed with two letters swapped')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='compare the results with a previously saved file')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    data = run(args)
+    print(f'Aliases indexed: {data["aliases"]}')
+    report(data, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(data, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,21 @@
 from __future__ import annotations
 
+import io
 import re
+import json
+import time
 import logging
 import asyncio
 from typing import Union
-from asyncio import TimeoutError
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime, timedelta
-from typing import TYPE_CHECKING, Optional, Literal
+from typing import TYPE_CHECKING, Any, Iterator, NamedTuple, Optional, Literal
 
 import asyncpg
 import discord
 from discord import app_commands
 from discord.ext import commands
+from lru import LRU
 
 from utils.fuzzy import finder
 from utils.cache import ExpiringCache
@@ -31,56 +34,497 @@ REPLIES_SETTINGS_TEXT = {
     2: 'On: Only when not pinged'
 }
 
+# Max number of entries that can be imported into a user's ignore list at once
+MAX_IGNORE_IMPORT = 500
+
+# Highlight DMs are sent by a fixed number of workers from a bounded queue
+DELIVERY_WORKERS = 4
+DELIVERY_QUEUE_SIZE = 500
+# Triggers for the same user within this many seconds are sent together
+COALESCE_WINDOW = 3
+DELIVERY_RETRIES = 3
+# Discord's limits for the embeds of a single message
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARACTERS = 6000
+
+
+class HighlightMatcher:
+    """Matches every highlight trigger of a guild in a single pass over a message.
+
+    Each trigger keeps the ``\\b<word>s?\\b`` semantics of the old per-user regex.
+    A combined pattern built from a trie of all the triggers finds the positions
+    where any trigger starts. Those positions are then resolved into
+    ``(user_id, matched text)`` pairs.
+    """
+
+    __slots__ = ('_users', '_subscribers', '_word_patterns', '_pattern', '_first_chars', '_buckets')
+
+    # Characters of the content looked up so far, cleared past this so odd messages can't grow it forever
+    MAX_BUCKETS = 4096
+
+    def __init__(self) -> None:
+        self._users: dict[int, dict[str, int]] = {}  # user_id: {word: position in the user's list}
+        self._subscribers: dict[str, list[int]] = {}  # word: [user_ids]
+        self._word_patterns: dict[str, re.Pattern] = {}
+        self._pattern: Optional[re.Pattern] = None
+        # (pattern matching the first character like IGNORECASE does, [(word, word pattern)])
+        self._first_chars: list[tuple[re.Pattern, list[tuple[str, re.Pattern]]]] = []
+        # {character of the content: [(word, word pattern)]}, filled in from _first_chars as characters are seen
+        self._buckets: Optional[dict[str, list[tuple[str, re.Pattern]]]] = None
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._users
+
+    @staticmethod
+    def _trie_pattern(words) -> str:
+        trie: dict = {}
+        for word in words:
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[''] = {}
+
+        def walk(node: dict) -> str:
+            alternatives = [re.escape(char) + walk(child) for char, child in node.items() if char]
+            if not alternatives:
+                return ''
+            body = alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')'
+            if '' in node:
+                # A shorter trigger ends here, so the rest of this branch is optional
+                body = f'(?:{body})?'
+            return body
+
+        return walk(trie)
+
+    def _invalidate(self) -> None:
+        self._pattern = None
+        self._buckets = None
+
+    def _compile(self) -> None:
+        # Only the combined pattern is rebuilt, each word's own pattern is kept between rebuilds
+        self._pattern = re.compile(r'\b(?=' + self._trie_pattern(self._subscribers) + r's?\b)', re.IGNORECASE)
+        groups = defaultdict(list)
+        for word in self._subscribers:
+            groups[word[0]].append((word, self._word_patterns[word]))
+        self._first_chars = [(re.compile(re.escape(char), re.IGNORECASE), entries) for char, entries in groups.items()]
+        self._buckets = {}
+
+    def _bucket(self, char: str) -> list[tuple[str, re.Pattern]]:
+        # str.lower() doesn't fold the way IGNORECASE does (e.g. 'ſ' matches 's', 'I' matches 'ı'),
+        # so the triggers a character can start are found with the same regex folding and cached
+        assert self._buckets is not None
+        try:
+            return self._buckets[char]
+        except KeyError:
+            pass
+        if len(self._buckets) >= self.MAX_BUCKETS:
+            self._buckets.clear()
+        bucket = [entry for pattern, entries in self._first_chars if pattern.fullmatch(char) for entry in entries]
+        self._buckets[char] = bucket
+        return bucket
+
+    def set_user(self, user_id: int, words: list[str]) -> None:
+        """Set the triggers for a user, replacing any they had before"""
+        self.remove_user(user_id)
+        if not words:
+            return
+
+        ranks = {}
+        for word in words:
+            word = word.lower()
+            if word in ranks:
+                continue
+            ranks[word] = len(ranks)
+            if word not in self._subscribers:
+                self._subscribers[word] = []
+                self._word_patterns[word] = re.compile(re.escape(word) + r's?\b', re.IGNORECASE)
+            self._subscribers[word].append(user_id)
+
+        self._users[user_id] = ranks
+        self._invalidate()
+
+    def remove_user(self, user_id: int) -> bool:
+        """Remove all the triggers for a user, returns whether the user had any"""
+        ranks = self._users.pop(user_id, None)
+        if ranks is None:
+            return False
+
+        for word in ranks:
+            subscribers = self._subscribers[word]
+            subscribers.remove(user_id)
+            if not subscribers:
+                del self._subscribers[word]
+                del self._word_patterns[word]
+
+        self._invalidate()
+        return True
+
+    def _hits(self, content: str) -> Iterator[tuple[int, str, str]]:
+        # Yields (start, word, matched text) for every trigger found in the content
+        if not self._subscribers:
+            return
+        if self._pattern is None:
+            self._compile()
+
+        for candidate in self._pattern.finditer(content):
+            start = candidate.start()
+            for word, pattern in self._bucket(content[start]):
+                match = pattern.match(content, start)
+                if match is not None:
+                    yield start, word, match.group(0)
+
+    def finditer(self, content: str) -> Iterator[tuple[int, str]]:
+        """Yields every ``(user_id, matched text)`` hit in the order they appear in the content"""
+        for _, word, text in self._hits(content):
+            for user_id in self._subscribers[word]:
+                yield user_id, text
+
+    def search(self, content: str) -> dict[int, str]:
+        """Returns the first hit for every user, the same as running each user's own regex"""
+        found: dict[int, str] = {}
+        # When multiple triggers of a user start at the same position,
+        # the one that came first in their list wins like it would in their own regex
+        pending: dict[int, tuple[int, str]] = {}
+        current = -1
+        for start, word, text in self._hits(content):
+            if start != current:
+                found.update((user_id, hit) for user_id, (_, hit) in pending.items())
+                pending.clear()
+                current = start
+
+            for user_id in self._subscribers[word]:
+                if user_id in found:
+                    continue
+                rank = self._users[user_id][word]
+                best = pending.get(user_id)
+                if best is None or rank < best[0]:
+                    pending[user_id] = (rank, text)
+
+        found.update((user_id, hit) for user_id, (_, hit) in pending.items())
+        return found
+
+
+class ChannelBuffer:
+    __slots__ = ('messages', 'complete_after')
+
+    def __init__(self, maxlen: int, complete_after: datetime):
+        self.messages: deque[discord.Message] = deque(maxlen=maxlen)
+        # Every message created after this point in time is in the buffer
+        self.complete_after: datetime = complete_after
+
+
+class RecentMessages:
+    """Memory capped ring buffers of the most recent messages in each channel.
+
+    The buffers are fed from gateway events so highlight context can be built
+    without fetching the channel history. Only the most recently active channels are kept.
+    """
+
+    def __init__(self, *, channels: int = 256, per_channel: int = 64):
+        self.per_channel: int = per_channel
+        self._buffers: LRU = LRU(channels)  # channel_id: ChannelBuffer
+
+    def add(self, message: discord.Message) -> None:
+        buffer = self._buffers.get(message.channel.id)
+        if buffer is None:
+            buffer = self._buffers[message.channel.id] = ChannelBuffer(self.per_channel, message.created_at)
+        elif len(buffer.messages) == buffer.messages.maxlen:
+            # The oldest message is about to be pushed out
+            buffer.complete_after = buffer.messages[0].created_at
+        buffer.messages.append(message)
+
+    def replace(self, message: discord.Message) -> None:
+        buffer = self._buffers.get(message.channel.id)
+        if buffer is None:
+            return
+        for index, msg in enumerate(buffer.messages):
+            if msg.id == message.id:
+                buffer.messages[index] = message
+                return
+
+    def remove(self, channel_id: int, message_ids: set[int]) -> None:
+        buffer = self._buffers.get(channel_id)
+        if buffer is None:
+            return
+        remaining = [msg for msg in buffer.messages if msg.id not in message_ids]
+        if len(remaining) != len(buffer.messages):
+            buffer.messages.clear()
+            buffer.messages.extend(remaining)
+
+    def discard(self, channel_id: int) -> None:
+        self._buffers.pop(channel_id, None)
+
+    def clear(self) -> None:
+        self._buffers.clear()
+
+    def before(self, message: discord.Message, *, after: datetime, limit: int) -> Optional[list[discord.Message]]:
+        """Get up to limit messages sent before the message and after the given time, oldest first.
+        Returns None if the buffer does not have all of them"""
+        buffer = self._buffers.get(message.channel.id)
+        if buffer is None:
+            return None
+
+        found = [msg for msg in buffer.messages if msg.id < message.id and msg.created_at > after]
+        if len(found) >= limit:
+            return found[-limit:]
+        if buffer.complete_after > after:
+            return None
+        return found
+
+    def after(self, message: discord.Message, *, limit: int) -> Optional[list[discord.Message]]:
+        """Get up to limit messages sent after the message, oldest first.
+        Returns None if the buffer does not have all of them"""
+        buffer = self._buffers.get(message.channel.id)
+        if buffer is None or buffer.complete_after > message.created_at:
+            return None
+        return [msg for msg in buffer.messages if msg.id > message.id][:limit]
+
+
+class ActivityTracker:
+    """Keeps track of when users were last active in each channel.
+
+    Entries are ordered by last activity, so entries older than the horizon are dropped from the front.
+    """
+
+    def __init__(self, *, horizon: float = 60):
+        self.horizon: float = horizon
+        self._last_active: OrderedDict[tuple[int, int], float] = OrderedDict()  # (channel_id, user_id): monotonic time
+
+    def touch(self, channel_id: int, user_id: int) -> None:
+        now = time.monotonic()
+        key = (channel_id, user_id)
+        self._last_active[key] = now
+        self._last_active.move_to_end(key)
+
+        cutoff = now - self.horizon
+        while self._last_active:
+            oldest = next(iter(self._last_active))
+            if self._last_active[oldest] >= cutoff:
+                break
+            del self._last_active[oldest]
+
+    def active_since(self, channel_id: int, user_ids: set[int], since: float) -> set[int]:
+        """Returns the users that were active in the channel since the given monotonic time"""
+        return {user_id for user_id in user_ids if self._last_active.get((channel_id, user_id), -1.0) >= since}
+
+
+class VisibilityCache:
+    """Caches whether members can read channels, per guild.
+
+    Entries are filled lazily and dropped when the channel, the guild's roles or the member's roles change.
+    Members that left the guild are remembered so they are never looked up again.
+    """
+
+    def __init__(self):
+        self._visible: dict[int, dict[int, dict[int, bool]]] = {}  # guild_id: {user_id: {channel_id: can read}}
+        self._departed: defaultdict[int, set[int]] = defaultdict(set)  # guild_id: {user_ids}
+
+    def can_read(self, channel: discord.abc.GuildChannel | discord.Thread, member: discord.Member) -> bool:
+        # Threads get their permissions from their parent channel
+        channel_id = getattr(channel, 'parent_id', None) or channel.id
+        entries = self._visible.setdefault(member.guild.id, {}).setdefault(member.id, {})
+        try:
+            return entries[channel_id]
+        except KeyError:
+            visible = entries[channel_id] = channel.permissions_for(member).read_messages
+            return visible
+
+    def invalidate_channel(self, guild_id: int, channel_id: int) -> None:
+        for entries in self._visible.get(guild_id, {}).values():
+            entries.pop(channel_id, None)
+
+    def invalidate_member(self, guild_id: int, user_id: int) -> None:
+        self._visible.get(guild_id, {}).pop(user_id, None)
+
+    def invalidate_guild(self, guild_id: int) -> None:
+        self._visible.pop(guild_id, None)
+
+    def mark_departed(self, guild_id: int, user_id: int) -> None:
+        self.invalidate_member(guild_id, user_id)
+        self._departed[guild_id].add(user_id)
+
+    def mark_present(self, guild_id: int, user_id: int) -> None:
+        departed = self._departed.get(guild_id)
+        if departed is not None:
+            departed.discard(user_id)
+
+    def is_departed(self, guild_id: int, user_id: int) -> bool:
+        departed = self._departed.get(guild_id)
+        return departed is not None and user_id in departed
+
+    def remove_guild(self, guild_id: int) -> None:
+        self._visible.pop(guild_id, None)
+        self._departed.pop(guild_id, None)
+
+
+class IgnoreList(NamedTuple):
+    users: frozenset[int]
+    channels: frozenset[int]
+
+    @classmethod
+    def from_records(cls, records: list[asyncpg.Record]) -> IgnoreList:
+        users = frozenset(r['target'] for r in records if r['type'] == 'user')
+        channels = frozenset(r['target'] for r in records if r['type'] == 'channel')
+        return cls(users=users, channels=channels)
+
+    @property
+    def empty(self) -> bool:
+        return not self.users and not self.channels
+
+    def with_target(self, target_type: Literal['user', 'channel'], target_id: int) -> IgnoreList:
+        if target_type == 'user':
+            return self._replace(users=self.users | {target_id})
+        return self._replace(channels=self.channels | {target_id})
+
+    def without_target(self, target_type: Literal['user', 'channel'], target_id: int) -> IgnoreList:
+        if target_type == 'user':
+            return self._replace(users=self.users - {target_id})
+        return self._replace(channels=self.channels - {target_id})
+
+    def to_dict(self) -> dict[str, list[int]]:
+        return {'user': sorted(self.users), 'channel': sorted(self.channels)}
+
+
+EMPTY_IGNORES = IgnoreList(users=frozenset(), channels=frozenset())
+
+
+class PendingHighlight:
+    __slots__ = ('user_id', 'embeds', 'triggers', 'queued_at', 'attempts', 'handle')
+
+    def __init__(self, user_id: int):
+        self.user_id: int = user_id
+        self.embeds: list[discord.Embed] = []
+        self.triggers: list[tuple[discord.Message, Optional[str]]] = []
+        self.queued_at: float = time.monotonic()
+        self.attempts: int = 0
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+    def add(self, embed: discord.Embed, message: discord.Message, word: Optional[str]) -> None:
+        self.embeds.append(embed)
+        self.triggers.append((message, word))
+
+    def batches(self) -> list[list[discord.Embed]]:
+        """Splits the embeds into messages that stay under the per-message embed count and size limits"""
+        batches: list[list[discord.Embed]] = []
+        size = 0
+        for embed in self.embeds:
+            length = len(embed)
+            if not batches or len(batches[-1]) >= MAX_EMBEDS_PER_MESSAGE or size + length > MAX_EMBED_CHARACTERS:
+                batches.append([])
+                size = 0
+            batches[-1].append(embed)
+            size += length
+        return batches
+
 
 class Highlights(commands.Cog):
-    highlights: dict[int, dict[int, re.Pattern]]  # guild_id: {user_id: re.Pattern}
-    ignores: dict[int, defaultdict[str, list[int]]]  # user_id: {user/channel: [target_ids]}
+    highlights: dict[int, HighlightMatcher]  # guild_id: HighlightMatcher
+    ignores: dict[int, IgnoreList]  # user_id: IgnoreList
     replies: dict[int, int]  # user_id: setting (0 = off, 1 = on always, 2 = no pings only)
 
     def __init__(self, bot: SnowflakeBot):
         self.bot: SnowflakeBot = bot
-        self.highlights = defaultdict(dict)
-        self.ignores = defaultdict(lambda: defaultdict(list))
+        self.highlights = defaultdict(HighlightMatcher)
+        self.ignores = {}
         self.replies = {}
         self.recent_triggers = ExpiringCache(seconds=60)
+        self.recent_messages = RecentMessages()
+        self.activity = ActivityTracker()
+        self.visibility = VisibilityCache()
+        self._resolving: set[tuple[int, int]] = set()
+
+        self._pending: dict[int, PendingHighlight] = {}  # user_id: PendingHighlight
+        self._delivery_queue: asyncio.Queue[PendingHighlight] = asyncio.Queue(maxsize=DELIVERY_QUEUE_SIZE)
+        self._workers: list[asyncio.Task] = []
+        self.delivery_latencies: deque[float] = deque(maxlen=1000)
+        self.delivered: int = 0
+        self.dropped: int = 0
         self.bot.loop.create_task(self.populate_cache())
 
+    async def cog_load(self) -> None:
+        self._workers = [self.bot.loop.create_task(self.delivery_worker()) for _ in range(DELIVERY_WORKERS)]
+
+    async def cog_unload(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        for pending in self._pending.values():
+            if pending.handle is not None:
+                pending.handle.cancel()
+
     def create_user_regex(self, words) -> re.Pattern:
         return re.compile(r'\b(' + '|'.join(map(re.escape, words)) + r')s?\b', re.IGNORECASE)
 
-    async def make_guild_cache(self, records: list[asyncpg.Record], guild: discord.Guild) -> dict[int, re.Pattern]:
-        collect_words = defaultdict(list)
-        for record in records:
-            collect_words[record['id']].append(record['word'])
+    async def find_departed_members(self, guild: discord.Guild, user_ids: list[int]) -> list[int]:
+        """Returns the user_ids that are no longer in the guild, uncached members are looked up in batches"""
+        missing = [user_id for user_id in user_ids if guild.get_member(user_id) is None]
+        if not missing or guild.chunked:
+            # The member cache is complete, anyone missing has left
+            return missing
 
-        left_guild = []
-        for user_id in collect_words:
+        departed = []
+        for i in range(0, len(missing), 100):
+            chunk = missing[i:i + 100]
             try:
-                member = guild.get_member(user_id) or (await guild.fetch_member(user_id))
-            except discord.NotFound:
-                left_guild.append(user_id)
-                query = '''DELETE FROM highlights WHERE id=$1 AND guild=$2;'''
-                await self.bot.pool.execute(query, user_id, guild.id)
-                log.info('Member %s not found in guild %s, deleting highlights...', user_id, guild.id)
-                continue
-
-        return {user_id: self.create_user_regex(words) for user_id, words in collect_words.items() if user_id not in left_guild}
+                members = await guild.query_members(user_ids=chunk, cache=True)
+            except asyncio.TimeoutError:
+                # We can't tell who left, so leave the rest alone
+                log.warning('Timed out querying %s highlight members in guild %s', len(missing) - i, guild.id)
+                break
+            found = {member.id for member in members}
+            departed.extend(user_id for user_id in chunk if user_id not in found)
+        return departed
+
+    async def make_guild_cache(self, users: dict[int, list[str]], guild: discord.Guild) -> tuple[HighlightMatcher, list[int]]:
+        """Build the matcher for a guild, returns the matcher and the user_ids that left the guild"""
+        departed = await self.find_departed_members(guild, list(users))
+        matcher = HighlightMatcher()
+        for user_id, words in users.items():
+            if user_id not in departed:
+                matcher.set_user(user_id, words)
+        return matcher, departed
 
     async def fetch_all_highlights(self) -> None:
-        query = '''SELECT id, word FROM highlights WHERE guild=$1;'''
-        for guild in self.bot.guilds:
-            records = await self.bot.pool.fetch(query, guild.id)
-            if not records:
+        start = time.perf_counter()
+        collect_words: defaultdict[int, defaultdict[int, list[str]]] = defaultdict(lambda: defaultdict(list))
+        query = '''SELECT guild, id, word FROM highlights;'''
+        rows = 0
+        async with self.bot.pool.acquire() as con:
+            async with con.transaction():
+                async for record in con.cursor(query, prefetch=1000):
+                    collect_words[record['guild']][record['id']].append(record['word'])
+                    rows += 1
+        log.info('Fetched %s highlights in %s guilds in %.2fms', rows, len(collect_words), (time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        departed: list[tuple[int, int]] = []
+        for guild_id, users in collect_words.items():
+            guild = self.bot.get_guild(guild_id)
+            if guild is None:
                 continue
-            guild_regex = await self.make_guild_cache(records, guild=guild)
-            if guild_regex:
-                self.highlights[guild.id] = guild_regex
+            matcher, left_guild = await self.make_guild_cache(users, guild=guild)
+            departed.extend((guild_id, user_id) for user_id in left_guild)
+            if matcher:
+                self.highlights[guild_id] = matcher
+        log.info('Built highlight matchers for %s guilds in %.2fms', len(self.highlights), (time.perf_counter() - start) * 1000)
+
+        if departed:
+            start = time.perf_counter()
+            query = '''DELETE FROM highlights
+                       WHERE (guild, id) IN (SELECT * FROM unnest($1::bigint[], $2::bigint[]));'''
+            guild_ids, user_ids = zip(*departed)
+            await self.bot.pool.execute(query, guild_ids, user_ids)
+            log.info('Deleted highlights of %s departed members in %.2fms', len(departed), (time.perf_counter() - start) * 1000)
 
     async def fetch_ignores(self) -> None:
         query = '''SELECT * FROM hl_ignores;'''
         records = await self.bot.pool.fetch(query)
+        collect_ignores = defaultdict(list)
         for r in records:
-            self.ignores[r['id']][r['type']].append(r['target'])
+            collect_ignores[r['id']].append(r)
+        self.ignores = {user_id: IgnoreList.from_records(rs) for user_id, rs in collect_ignores.items()}
 
     async def fetch_dm_mentions(self) -> None:
         query = '''SELECT * FROM hl_replies;'''
@@ -91,13 +535,19 @@ class Highlights(commands.Cog):
     async def populate_cache(self) -> None:
         await self.bot.wait_until_ready()
         await self.fetch_all_highlights()
+
+        start = time.perf_counter()
         await self.fetch_ignores()
+        log.info('Fetched highlight ignores in %.2fms', (time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
         await self.fetch_dm_mentions()
+        log.info('Fetched highlight replies in %.2fms', (time.perf_counter() - start) * 1000)
 
     async def delete_highlights(self, user_id: int, guild_id: int) -> None:
         query = '''DELETE FROM highlights WHERE id=$1 AND guild=$2;'''
         await self.bot.pool.execute(query, user_id, guild_id)
-        self.highlights[guild_id].pop(user_id, None)
+        self.highlights[guild_id].remove_user(user_id)
         if not self.highlights[guild_id]:
             self.highlights.pop(guild_id, None)
 
@@ -110,11 +560,12 @@ class Highlights(commands.Cog):
         query = '''SELECT word FROM highlights WHERE guild=$1 AND id=$2;'''
         records = await self.bot.pool.fetch(query, guild_id, user_id)
         if not records:
-            self.highlights[guild_id].pop(user_id, None)
+            self.highlights[guild_id].remove_user(user_id)
             if not self.highlights[guild_id]:
                 self.highlights.pop(guild_id, None)
             return
-        self.highlights[guild_id][user_id] = self.create_user_regex([r['word'] for r in records])
+        # Only this guild's matcher is rebuilt
+        self.highlights[guild_id].set_user(user_id, [r['word'] for r in records])
 
     async def update_user_ignores(self, user_id: int):
         query = '''SELECT type, target FROM hl_ignores WHERE id=$1;'''
@@ -122,8 +573,7 @@ class Highlights(commands.Cog):
         if not records:
             self.ignores.pop(user_id, None)
             return
-        for r in records:
-            self.ignores[user_id][r['type']].append(r['target'])
+        self.ignores[user_id] = IgnoreList.from_records(records)
 
     def should_ignore(self, user_id: int, message: discord.Message) -> bool:
         """Check if message should be ignored, returns True if it should be ignored"""
@@ -131,40 +581,31 @@ class Highlights(commands.Cog):
             return True
 
         ignores = self.ignores.get(user_id)
-        if ignores:
-            if message.author.id in ignores.get('user', []):
+        if ignores is not None:
+            if message.author.id in ignores.users:
                 return True
-            elif message.channel.id in ignores.get('channel', []):
+            elif message.channel.id in ignores.channels:
                 return True
         return False
 
-    async def get_msg_context(self, message: discord.Message, minutes: int = 5, limit: int = 50) -> tuple[list[discord.Message], list[discord.Message]]:
-        """Get the context of a message, returns a tuple of previous and recent messages"""
-        now = message.created_at
-
-        # get all messages within the last few minutes, default 5
-        # we will do it in a task so we can start the wait_for sooner
-        async def fetch_prev() -> list[discord.Message]:
-            return [msg async for msg in message.channel.history(limit=limit, after=now - timedelta(minutes=minutes), before=message)]
-
-        task = self.bot.loop.create_task(fetch_prev())
-
-        # get all messages within last 40 seconds, we will filter from our previous list to save an API call
-        # recent_messages = [msg for msg in prev_messages[:-1] if (now - msg.created_at).seconds <= recent]
+    async def get_msg_context(self, message: discord.Message, minutes: int = 5, limit: int = 50, timeout: int = 20) -> tuple[list[discord.Message], list[discord.Message]]:
+        """Get the context of a message, returns a tuple of previous and recent messages
 
-        after = []
+        Messages come from the recent messages buffer, the channel history is only fetched if the buffer does not have them"""
+        window = message.created_at - timedelta(minutes=minutes)
 
-        def check(msg: discord.Message):
-            if msg.channel == message.channel:
-                after.append(msg)
-            return len(after) == 3
+        # get all messages within the last few minutes, default 5
+        # this is done right away before they get pushed out of the buffer
+        prev = self.recent_messages.before(message, after=window, limit=limit)
+        if prev is None:
+            prev = [msg async for msg in message.channel.history(limit=limit, after=window, before=message)]
 
-        try:
-            await self.bot.wait_for('message', check=check, timeout=20)
-        except TimeoutError:
-            pass
+        # give the channel some time to continue the conversation, then grab up to 3 messages after
+        await asyncio.sleep(timeout)
+        after = self.recent_messages.after(message, limit=3)
+        if after is None:
+            after = [msg async for msg in message.channel.history(limit=3, after=message)]
 
-        prev = await task
         prev.append(message)
         return prev, after
 
@@ -208,25 +649,93 @@ class Highlights(commands.Cog):
 
         return '\n'.join(context)
 
-    async def _send_highlight_dm(self, user_id: int, embed: discord.Embed, message: discord.Message, word: Optional[str]) -> None:
+    def queue_highlight(self, user_id: int, embed: discord.Embed, message: discord.Message, word: Optional[str]) -> None:
+        """Queue a highlight DM, merging it with any highlight still waiting to be sent to the user"""
+        pending = self._pending.get(user_id)
+        if pending is None:
+            pending = self._pending[user_id] = PendingHighlight(user_id)
+            pending.handle = self.bot.loop.call_later(COALESCE_WINDOW, self._enqueue_pending, pending)
+        pending.add(embed, message, word)
+
+    def _enqueue_pending(self, pending: PendingHighlight) -> None:
+        self._pending.pop(pending.user_id, None)
+        pending.handle = None
+        try:
+            self._delivery_queue.put_nowait(pending)
+        except asyncio.QueueFull:
+            self.dropped += len(pending.triggers)
+            log.warning('Highlight delivery queue is full, dropped %s highlights for %s', len(pending.triggers), pending.user_id)
+
+    async def delivery_worker(self) -> None:
+        while True:
+            pending = await self._delivery_queue.get()
+            try:
+                await self._send_highlight_dm(pending)
+            except Exception:
+                log.exception('Failed to deliver highlights to %s', pending.user_id)
+            finally:
+                self._delivery_queue.task_done()
+
+    async def _send_highlight_dm(self, pending: PendingHighlight) -> None:
+        user_id = pending.user_id
+        guild_ids = {message.guild.id for message, _ in pending.triggers}
         try:
             user = self.bot.get_user(user_id) or (await self.bot.fetch_user(user_id))
-            await user.send(embed=embed)
+            # discord.py already waits out the per-route buckets, the worker count limits how many DMs go out at once
+            for batch in pending.batches():
+                await user.send(embeds=batch)
+                # A retry after a rate limit only sends what is left
+                del pending.embeds[:len(batch)]
         except discord.NotFound:
             log.info('User %s not found, deleting highlights and replies permanently', user_id)
-            await self.delete_highlights(user_id, message.guild.id)
+            for guild_id in guild_ids:
+                await self.delete_highlights(user_id, guild_id)
             await self.delete_replies(user_id)
             return
         except discord.Forbidden as e:
             if "Cannot send messages to this user" in e.text:
                 log.info('User %s has DMs disabled, deleting highlights and replies from cache', user_id)
-                self.highlights[message.guild.id].pop(user_id, None)
+                for guild_id in guild_ids:
+                    self.highlights[guild_id].remove_user(user_id)
                 self.replies.pop(user_id, None)
                 # await self.delete_highlights(user_id, message.guild.id)
                 # await self.delete_replies(user_id)
                 return
+        except discord.HTTPException as e:
+            if e.status != 429 or pending.attempts >= DELIVERY_RETRIES:
+                self.dropped += len(pending.triggers)
+                raise
+            pending.attempts += 1
+            self.bot.loop.call_later(2 ** pending.attempts, self._retry_pending, pending)
         else:
-            self.bot.dispatch('highlight_sent', user_id, message, word)
+            self.delivered += len(pending.triggers)
+            self.delivery_latencies.append(time.monotonic() - pending.queued_at)
+            for message, word in pending.triggers:
+                self.bot.dispatch('highlight_sent', user_id, message, word)
+
+    def _retry_pending(self, pending: PendingHighlight) -> None:
+        try:
+            self._delivery_queue.put_nowait(pending)
+        except asyncio.QueueFull:
+            self.dropped += len(pending.triggers)
+
+    def delivery_stats(self) -> dict[str, Union[int, float]]:
+        """Returns the current state of the highlight delivery queue, latencies are in seconds"""
+        latencies = sorted(self.delivery_latencies)
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        return {
+            'queued': self._delivery_queue.qsize(),
+            'coalescing': len(self._pending),
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'latency_p50': percentile(0.5),
+            'latency_p99': percentile(0.99),
+        }
 
     async def send_highlight_notif(self, message: discord.Message, user_id: int, word: str, prev: list[discord.Message], after: list[discord.Message]) -> None:
         now = message.created_at
@@ -249,7 +758,7 @@ class Highlights(commands.Cog):
         )
         embed.set_footer(text=f'Highlight trigger: {word}')
 
-        await self._send_highlight_dm(user_id, embed, message, word)
+        self.queue_highlight(user_id, embed, message, word)
 
     async def send_reply_notification(self, message: discord.Message, user_id: int, word: None, prev: list[discord.Message], after: list[discord.Message]) -> None:
         now = message.created_at
@@ -286,62 +795,49 @@ class Highlights(commands.Cog):
             ref = message.reference.resolved.jump_url
             embed.description += f' | [Replying to]({ref})'
 
-        await self._send_highlight_dm(user_id, embed, message, word)
+        self.queue_highlight(user_id, embed, message, word)
 
     async def wait_for_activity(self, message: discord.Message, user_ids: set[int], timeout: int = 20) -> set[int]:
         """Wait for activity from a list of user_ids"""
-        active = set()
-
-        # We will leverage the check functions to just add the user into the active set
-        # and return False to keep the wait_for running for the full timeout
-        def message_check(m: discord.Message):
-            if m.author.id in user_ids and m.channel == message.channel:
-                active.add(m.author.id)
-            return False
-
-        def typing_check(c: discord.abc.Messageable, u: discord.User, w: datetime):
-            if u.id in user_ids and c == message.channel:
-                active.add(u.id)
-            return False
-
-        def reaction_check(r: discord.Reaction, u: discord.Member):
-            if u.id in user_ids and r.message.channel == message.channel:
-                active.add(u.id)
-            return False
-
-        tasks_names = [
-            ('message', message_check),
-            ('typing', typing_check),
-            ('reaction_add', reaction_check)
-        ]
-        tasks = [asyncio.create_task(self.bot.wait_for(name, check=check)) for name, check in tasks_names]
-        done, pending = await asyncio.wait(tasks, timeout=timeout)
-        # these tasks never complete since all our checks return False
-        for task in tasks:
-            try:
-                # task.add_done_callback(lambda f: f.exception())
-                task.cancel()
-            except Exception:
-                pass
+        # Messages, typing and reactions are all recorded by the activity tracker
+        # so we only need to check who was active once the time is up
+        start = time.monotonic()
+        await asyncio.sleep(timeout)
+        return self.activity.active_since(message.channel.id, user_ids, start)
+
+    async def resolve_member(self, guild: discord.Guild, user_id: int) -> None:
+        """Look up a highlight member that is not cached, deleting their highlights if they left"""
+        try:
+            members = await guild.query_members(user_ids=[user_id], cache=True)
+        except asyncio.TimeoutError:
+            return
+        finally:
+            self._resolving.discard((guild.id, user_id))
 
-        return active
+        if not members:
+            log.warning('Highlight member %s not found in guild %s, deleting...', user_id, guild.id)
+            self.visibility.mark_departed(guild.id, user_id)
+            await self.delete_highlights(user_id, guild.id)
 
     async def handle_highlights(self, message: discord.Message, highlights: dict[int, Optional[str]]) -> None:
         """Handle highlights"""
         filtered = {}
+        guild = message.guild
         for user_id, word in highlights.items():
-            if not self.should_ignore(user_id, message):
-                if user_id == self.bot.owner_id:
-                    filtered[user_id] = word
-                else:
-                    try:
-                        member = message.guild.get_member(user_id) or (await message.guild.fetch_member(user_id))
-                    except discord.NotFound:
-                        log.warning('Highlight member %s not found in guild %s, deleting...', user_id, message.guild.id)
-                        await self.delete_highlights(user_id, message.guild.id)
-                    else:
-                        if message.channel.permissions_for(member).read_messages:
-                            filtered[user_id] = word
+            if self.should_ignore(user_id, message):
+                continue
+            if user_id == self.bot.owner_id:
+                filtered[user_id] = word
+                continue
+
+            member = guild.get_member(user_id)
+            if member is None:
+                # Never wait on the API here, look them up in the background and skip this trigger
+                if not self.visibility.is_departed(guild.id, user_id) and (guild.id, user_id) not in self._resolving:
+                    self._resolving.add((guild.id, user_id))
+                    self.bot.loop.create_task(self.resolve_member(guild, user_id))
+            elif self.visibility.can_read(message.channel, member):
+                filtered[user_id] = word
         if not filtered:
             return
         active_task = self.bot.loop.create_task(self.wait_for_activity(message, set(filtered.keys()), timeout=20))
@@ -351,21 +847,24 @@ class Highlights(commands.Cog):
             if user_id in active_users:
                 continue
             if word:
-                self.bot.loop.create_task(self.send_highlight_notif(message, user_id, word, prev, after))
+                await self.send_highlight_notif(message, user_id, word, prev, after)
             else:
-                self.bot.loop.create_task(self.send_reply_notification(message, user_id, word, prev, after))
+                await self.send_reply_notification(message, user_id, word, prev, after)
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
-        if message.guild is None or message.author.bot or message.webhook_id is not None:
+        if message.guild is None:
+            return
+
+        self.recent_messages.add(message)
+        if message.author.bot or message.webhook_id is not None:
             return
 
+        self.activity.touch(message.channel.id, message.author.id)
+
         to_send = {}
         if message.guild.id in self.highlights:
-            for member_id, regex in self.highlights[message.guild.id].items():
-                match = regex.search(message.content)
-                if match:
-                    to_send[member_id] = match.group(0)
+            to_send = self.highlights[message.guild.id].search(message.content)
 
         if message.type is discord.MessageType.reply:
             if message.reference and isinstance(message.reference.resolved, discord.Message):
@@ -376,6 +875,83 @@ class Highlights(commands.Cog):
         if to_send:
             await self.handle_highlights(message, to_send)
 
+    @commands.Cog.listener()
+    async def on_message_edit(self, before: discord.Message, after: discord.Message):
+        if after.guild is not None:
+            self.recent_messages.replace(after)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        if payload.guild_id is not None:
+            self.recent_messages.remove(payload.channel_id, {payload.message_id})
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        if payload.guild_id is not None:
+            self.recent_messages.remove(payload.channel_id, payload.message_ids)
+
+    @commands.Cog.listener()
+    async def on_raw_typing(self, payload: discord.RawTypingEvent):
+        if payload.guild_id is not None:
+            self.activity.touch(payload.channel_id, payload.user_id)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        if payload.guild_id is not None:
+            self.activity.touch(payload.channel_id, payload.user_id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        self.recent_messages.discard(channel.id)
+        self.visibility.invalidate_channel(channel.guild.id, channel.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+        self.visibility.invalidate_channel(after.guild.id, after.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        if before.permissions != after.permissions:
+            self.visibility.invalidate_guild(after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        self.visibility.invalidate_guild(role.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_update(self, before: discord.Guild, after: discord.Guild):
+        if before.owner_id != after.owner_id:
+            self.visibility.invalidate_guild(after.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        self.visibility.remove_guild(guild.id)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if before.roles != after.roles:
+            self.visibility.invalidate_member(after.guild.id, after.id)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member):
+        self.visibility.mark_present(member.guild.id, member.id)
+        self.visibility.invalidate_member(member.guild.id, member.id)
+
+    @commands.Cog.listener()
+    async def on_raw_member_remove(self, payload: discord.RawMemberRemoveEvent):
+        user_id = payload.user.id
+        matcher = self.highlights.get(payload.guild_id)
+        # Only remember the members that could still be highlighted
+        if (matcher is not None and user_id in matcher) or user_id in self.replies:
+            self.visibility.mark_departed(payload.guild_id, user_id)
+        else:
+            self.visibility.invalidate_member(payload.guild_id, user_id)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # A new session means events could have been missed, so the buffers can't be trusted anymore
+        self.recent_messages.clear()
+
     @commands.hybrid_group(aliases=['hl'])
     @commands.guild_only()
     async def highlight(self, ctx: Context):
@@ -556,18 +1132,37 @@ class Highlights(commands.Cog):
     async def add_block(self, user_id: int, target_type: Literal['user', 'channel'], target_id: int):
         query = '''INSERT INTO hl_ignores(id, type, target) VALUES($1, $2, $3);'''
         await self.bot.pool.execute(query, user_id, target_type, target_id)
-        self.ignores[user_id][target_type].append(target_id)
+        self.ignores[user_id] = self.ignores.get(user_id, EMPTY_IGNORES).with_target(target_type, target_id)
 
     async def remove_block(self, user_id: int, target_type: Literal['user', 'channel'], target_id: int):
         query = '''DELETE FROM hl_ignores WHERE id=$1 AND type=$2 AND target=$3;'''
         result = await self.bot.pool.execute(query, user_id, target_type, target_id)
-        self.ignores[user_id][target_type].remove(target_id)
-        if not self.ignores[user_id][target_type]:
-            self.ignores[user_id].pop(target_type)
-            if not self.ignores[user_id]:
-                self.ignores.pop(user_id)
+        ignores = self.ignores.get(user_id, EMPTY_IGNORES).without_target(target_type, target_id)
+        if ignores.empty:
+            self.ignores.pop(user_id, None)
+        else:
+            self.ignores[user_id] = ignores
         return result
 
+    def export_ignores(self, user_id: int) -> dict[str, list[int]]:
+        """Returns a user's blocked users and channels"""
+        return self.ignores.get(user_id, EMPTY_IGNORES).to_dict()
+
+    async def import_ignores(self, user_id: int, data: dict[str, list[int]]) -> int:
+        """Bulk add blocked users and channels, returns how many were added"""
+        types, targets = [], []
+        for target_type in ('user', 'channel'):
+            for target_id in data.get(target_type, []):
+                types.append(target_type)
+                targets.append(int(target_id))
+
+        query = '''INSERT INTO hl_ignores(id, type, target)
+                   SELECT $1, t.type, t.target FROM unnest($2::text[], $3::bigint[]) AS t(type, target)
+                   ON CONFLICT DO NOTHING;'''
+        result = await self.bot.pool.execute(query, user_id, types, targets)
+        await self.update_user_ignores(user_id)
+        return int(result.split()[-1])
+
     @highlight.command(name='ignore', aliases=['block'], with_app_command=False)
     async def highlight_block(self, ctx: Context, *, target: Union[discord.User, discord.abc.GuildChannel, str]):
         """Block a user or channel from triggering your highlights"""
@@ -732,6 +1327,43 @@ class Highlights(commands.Cog):
         else:
             await ctx.send(embed=e, ephemeral=True)
 
+    @highlight.command(name='exportblocks', with_app_command=False)
+    async def highlight_export_blocks(self, ctx: Context):
+        """Export your blocked users and channels as a file
+        The file can be imported again with `highlight importblocks`"""
+        data = self.export_ignores(ctx.author.id)
+        if not data['user'] and not data['channel']:
+            return await ctx.send('You do not have any blocked users or channels')
+
+        fp = io.BytesIO(json.dumps(data, indent=2).encode('utf-8'))
+        await ctx.send(file=discord.File(fp, filename='highlight_blocks.json'))
+
+    @highlight.command(name='importblocks', with_app_command=False)
+    async def highlight_import_blocks(self, ctx: Context):
+        """Import blocked users and channels from a file made by `highlight exportblocks`
+        Attach the file to the message, existing blocks are kept"""
+        if not ctx.message.attachments:
+            await ctx.tick(False)
+            return await ctx.send('Please attach the file to import')
+
+        try:
+            data: Any = json.loads(await ctx.message.attachments[0].read())
+            if not isinstance(data, dict):
+                raise ValueError
+            data = {k: [int(target) for target in data.get(k, [])] for k in ('user', 'channel')}
+        except (ValueError, TypeError, discord.HTTPException):
+            await ctx.tick(False)
+            return await ctx.send('That file is not a valid highlight blocks file')
+
+        total = len(data['user']) + len(data['channel'])
+        if total > MAX_IGNORE_IMPORT:
+            await ctx.tick(False)
+            return await ctx.send(f'You can only import up to {MAX_IGNORE_IMPORT} blocks at once')
+
+        added = await self.import_ignores(ctx.author.id, data)
+        await ctx.tick(True)
+        await ctx.send(f'Imported {added} new blocks', delete_after=7)
+
     @highlight.group(name='clear')
     async def highlight_clear_group(self, ctx: Context):
         """Clear your highlight triggers or blocks"""
@@ -767,6 +1399,20 @@ class Highlights(commands.Cog):
         else:
             await ctx.send(f'{await ctx.tick(reaction=False)} Successfully cleared all your highlight blocks', ephemeral=True)
 
+    @highlight.command(name='stats', with_app_command=False, hidden=True)
+    @commands.is_owner()
+    async def highlight_stats(self, ctx: Context):
+        """Shows the state of the highlight delivery queue"""
+        stats = self.delivery_stats()
+        e = discord.Embed(title='Highlight Delivery', colour=discord.Colour.blurple())
+        e.add_field(name='Queued', value=stats['queued'])
+        e.add_field(name='Coalescing', value=stats['coalescing'])
+        e.add_field(name='Delivered', value=stats['delivered'])
+        e.add_field(name='Dropped', value=stats['dropped'])
+        e.add_field(name='Latency p50', value=f'{stats["latency_p50"]:.2f}s')
+        e.add_field(name='Latency p99', value=f'{stats["latency_p99"]:.2f}s')
+        await ctx.send(embed=e)
+
     @highlight.command(with_app_command=False, name='info')
     async def highlight_info(self, ctx: Context):
         """Explains how highlight works"""
@@ -1,17 +1,25 @@
 from __future__ import annotations
 
+import os
+import json
+import fcntl
+import logging
+import heapq
 import asyncio
+import pathlib
+import secrets
 import textwrap
 import datetime
 import traceback
-from typing import TYPE_CHECKING, Any, Optional, Self, Sequence, Annotated
+from typing import TYPE_CHECKING, Any, Optional, Self, Sequence, Annotated, TextIO
 
 import asyncpg
 import discord
 from discord import app_commands
 from discord.ext import commands, tasks
 
-from utils import time
+from utils import metrics, time
+from utils.cache import ExpiringCache
 from utils.fuzzy import finder
 
 if TYPE_CHECKING:
@@ -19,6 +27,8 @@ if TYPE_CHECKING:
     from utils.context import Context
     from cogs.timezone import Timezone
 
+log = logging.getLogger(__name__)
+
 
 class SnoozeModal(discord.ui.Modal, title='Snooze'):
     duration = discord.ui.TextInput(label='Duration', placeholder='10 minutes', default='10 minutes', min_length=2)
@@ -91,7 +101,7 @@ class ReminderView(discord.ui.View):
 
 
 class Timer:
-    __slots__ = ('args', 'kwargs', 'event', 'id', 'created_at', 'expires', 'timezone')
+    __slots__ = ('args', 'kwargs', 'event', 'id', 'created_at', 'expires', 'timezone', 'journal_key')
 
     def __init__(self, *, record: asyncpg.Record):
         self.id: int = record['id']
@@ -103,6 +113,8 @@ class Timer:
         self.created_at: datetime.datetime = record['created']
         self.expires: datetime.datetime = record['expires']
         self.timezone: str = record['timezone']
+        # Set on short timers, their journal entry is only marked done once the timer is handled
+        self.journal_key: Optional[str] = None
 
     @classmethod
     def temporary(
@@ -148,58 +160,368 @@ class Timer:
         return f'<Timer created={self.created_at} expires={self.expires} event={self.event}>'
 
 
+class ShortTimerJournal:
+    """Append-only journal of the short timers that are only kept in memory.
+
+    Every line is a JSON entry that either adds a timer or marks one as done.
+    The journal is replayed on load and compacted whenever the finished timers outnumber the pending ones.
+    Each process claims its own journal file with a lock so processes sharing the database never replay each other's.
+    """
+
+    # Compacting a handful of lines isn't worth rewriting the file
+    COMPACT_MIN_DONE = 64
+
+    def __init__(self, directory: pathlib.Path, name: str = 'short_timers'):
+        self.directory: pathlib.Path = directory
+        self.name: str = name
+        self.path: Optional[pathlib.Path] = None
+        self._fp: Optional[TextIO] = None
+        self._lock: Optional[TextIO] = None
+        self._entries: dict[str, dict[str, Any]] = {}
+        self._done: int = 0
+
+    def _claim(self) -> pathlib.Path:
+        """Lock the first journal no other running process holds, a restarted process picks a free one back up"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        slot = 0
+        while True:
+            lock = (self.directory / f'{self.name}.{slot}.lock').open('w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                slot += 1
+                continue
+            self._lock = lock
+            return self.directory / f'{self.name}.{slot}.journal'
+
+    def replay(self) -> dict[str, Timer]:
+        """Returns the timers that never completed, keyed by their journal key"""
+        if self.path is None:
+            self.path = self._claim()
+
+        entries: dict[str, dict[str, Any]] = {}
+        try:
+            with self.path.open(encoding='utf-8') as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A write that was cut off
+                        continue
+                    if entry['op'] == 'add':
+                        entries[entry['key']] = entry
+                    else:
+                        entries.pop(entry['key'], None)
+        except FileNotFoundError:
+            pass
+
+        self._entries = entries
+        self._compact()
+
+        return {
+            key: Timer.temporary(
+                event=entry['event'],
+                args=entry['args'],
+                kwargs=entry['kwargs'],
+                created=datetime.datetime.fromisoformat(entry['created']),
+                expires=datetime.datetime.fromisoformat(entry['expires']),
+                timezone=entry['timezone'],
+            )
+            for key, entry in entries.items()
+        }
+
+    def _compact(self) -> None:
+        """Rewrite the journal so it only contains the pending timers"""
+        assert self.path is not None
+        if self._fp is not None:
+            self._fp.close()
+        tmp = self.path.with_suffix('.tmp')
+        with tmp.open('w', encoding='utf-8') as fp:
+            for entry in self._entries.values():
+                fp.write(json.dumps(entry) + '\n')
+        os.replace(tmp, self.path)
+        self._fp = self.path.open('a', encoding='utf-8')
+        self._done = 0
+
+    def _write(self, entry: dict[str, Any]) -> None:
+        if self._fp is None:
+            log.warning('Short timer journal is not open, %s for %s will not survive a restart', entry['op'], entry['key'])
+            return
+        # Flushing is enough to survive the process restarting
+        self._fp.write(json.dumps(entry) + '\n')
+        self._fp.flush()
+
+    def add(self, timer: Timer) -> str:
+        key = secrets.token_hex(8)
+        entry = {
+            'op': 'add',
+            'key': key,
+            'event': timer.event,
+            'args': list(timer.args),
+            'kwargs': timer.kwargs,
+            'created': timer.created_at.isoformat(),
+            'expires': timer.expires.isoformat(),
+            'timezone': timer.timezone,
+        }
+        self._entries[key] = entry
+        self._write(entry)
+        return key
+
+    def done(self, key: str) -> None:
+        if self._entries.pop(key, None) is None:
+            return
+        self._write({'op': 'done', 'key': key})
+        self._done += 1
+        if self._fp is not None and self._done >= self.COMPACT_MIN_DONE and self._done > len(self._entries):
+            self._compact()
+
+    def close(self) -> None:
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+
+
+TYPING_EMOJI = '<a:typing:559157048919457801>'
+
+
 class Reminders(commands.Cog):
+    # Timers expiring within this window are kept in memory and dispatched from a heap
+    PREFETCH_WINDOW = datetime.timedelta(minutes=10)
+    # Creates and cancels are announced here so every process sharing the timers table keeps its heap in sync
+    NOTIFY_CHANNEL = 'timers'
+    DESKTOP_EXPIRY = datetime.timedelta(days=7)
+    # Short timer events whose handler marks the journal entry done itself after delivering it
+    JOURNAL_ACKNOWLEDGED_EVENTS = frozenset({'reminder'})
+
     def __init__(self, bot: SnowflakeBot):
         self.bot: SnowflakeBot = bot
-        self._have_data: asyncio.Event = asyncio.Event()
-        self._current_timer: Optional[Timer] = None
+        self._wakeup: asyncio.Event = asyncio.Event()
+        self._heap: list[tuple[datetime.datetime, int]] = []  # (expires, id)
+        self._scheduled: dict[int, Timer] = {}  # id: Timer, only the timers in the heap
+        self._window_end: datetime.datetime = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        # Timers of 60 seconds or less never touch the database, the journal keeps them across restarts
+        self.journal: ShortTimerJournal = ShortTimerJournal(pathlib.Path('./data'))
+        self._short_timers: set[asyncio.Task] = set()
+        # {user_id: [(id, expires, message)]}, saves querying on every keystroke of the autocomplete
+        self._autocomplete_cache: ExpiringCache = ExpiringCache(seconds=30, maxsize=1000)
+        # {user_id: {timer_id: Timer}}, pending %desktop reminders checked on every presence update
+        self._desktop_reminders: dict[int, dict[int, Timer]] = {}
+        # Identifies this process in notifications so it can skip its own
+        self._origin: str = secrets.token_hex(8)
+        self._listener: Optional[asyncpg.Connection] = None
+        self.dispatch_lag: metrics.Histogram = metrics.histogram(
+            'reminder_dispatch_lag_seconds', 'Time between a timer expiring and it being dispatched'
+        )
+        self.handler_duration: metrics.Histogram = metrics.histogram(
+            'reminder_handler_seconds', 'Time spent in on_reminder_timer_complete'
+        )
+        self.heap_size: metrics.Histogram = metrics.histogram(
+            'reminder_heap_size', 'Timers waiting in the dispatch heap',
+            buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000),
+        )
+        self.batch_size: metrics.Histogram = metrics.histogram(
+            'reminder_batch_size', 'Due timers dispatched together',
+            buckets=(1, 2, 5, 10, 50, 100, 500, 1000),
+        )
         self.weekly_check.start()
         self._task = bot.loop.create_task(self.dispatch_timers())
 
+    async def cog_load(self) -> None:
+        now = discord.utils.utcnow()
+        for key, timer in self.journal.replay().items():
+            self.start_short_timer((timer.expires - now).total_seconds(), timer, key)
+
+        query = '''SELECT * FROM timers WHERE event = 'desktop';'''
+        for record in await self.bot.pool.fetch(query):
+            self.register_desktop(Timer(record=record))
+
+        await self.listen_for_timers()
+
     async def cog_unload(self) -> None:
         self._task.cancel()
         self.weekly_check.cancel()
+        # These are still in the journal and will be picked up again on load
+        for task in self._short_timers:
+            task.cancel()
+        self.journal.close()
+        if self._listener is not None:
+            listener, self._listener = self._listener, None
+            listener.remove_termination_listener(self._on_listener_terminated)
+            try:
+                await listener.remove_listener(self.NOTIFY_CHANNEL, self._on_timer_notification)
+            finally:
+                await self.release_listener(listener)
+
+    async def listen_for_timers(self) -> None:
+        """Hold a connection that listens for timers created or cancelled by other processes"""
+        listener = await self.bot.pool.acquire()
+        try:
+            listener.add_termination_listener(self._on_listener_terminated)
+            await listener.add_listener(self.NOTIFY_CHANNEL, self._on_timer_notification)
+        except BaseException:
+            await self.release_listener(listener)
+            raise
+        self._listener = listener
 
-    async def get_active_timer(self, *, days: int) -> Optional[Timer]:
-        query = '''SELECT * FROM timers WHERE expires < (now() + $1::interval) ORDER BY expires LIMIT 1'''
-        record = await self.bot.pool.fetchrow(query, datetime.timedelta(days=days))
-        if record:
-            return Timer(record=record)
+    async def release_listener(self, listener: asyncpg.Connection) -> None:
+        # A dead connection still holds its slot in the pool until it is released
+        try:
+            await self.bot.pool.release(listener)
+        except Exception:
+            log.warning('Could not release the timer listener connection', exc_info=True)
+            listener.terminate()
+
+    def _on_listener_terminated(self, connection: asyncpg.Connection) -> None:
+        listener, self._listener = self._listener, None
+        # Anything announced while disconnected was missed, so refetch the window
+        self._window_end = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        self._wakeup.set()
+        self.bot.loop.create_task(self._relisten(listener))
+
+    async def _relisten(self, dead: Optional[asyncpg.Connection] = None) -> None:
+        if dead is not None:
+            await self.release_listener(dead)
+        while self._listener is None and not self.bot.is_closed():
+            try:
+                await self.listen_for_timers()
+            except (OSError, asyncpg.PostgresError):
+                await asyncio.sleep(5)
 
-    async def call_timer(self, timer: Timer) -> None:
-        """Delete the timer from the database and dispatch the event."""
-        query = '''DELETE FROM timers WHERE id = $1'''
-        await self.bot.pool.execute(query, timer.id)
+    def _on_timer_notification(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        data = json.loads(payload)
+        if data['origin'] == self._origin:
+            return
 
-        self.bot.dispatch(f'{timer.event}_timer_complete', timer)
+        if data['op'] == 'cancel':
+            self.unschedule(data['id'])
+            self.unregister_desktop(data['author_id'], data['id'])
+            self._autocomplete_cache.pop(data['author_id'], None)
+        elif data['op'] == 'create':
+            self._autocomplete_cache.pop(data['author_id'], None)
+            if data['event'] == 'desktop' or datetime.datetime.fromisoformat(data['expires']) < self._window_end:
+                self.bot.loop.create_task(self._load_timer(data['id']))
+
+    async def _load_timer(self, timer_id: int) -> None:
+        query = '''SELECT * FROM timers WHERE id = $1'''
+        record = await self.bot.pool.fetchrow(query, timer_id)
+        if record is None:
+            return
+
+        timer = Timer(record=record)
+        if timer.event == 'desktop':
+            self.register_desktop(timer)
+        if timer.expires < self._window_end:
+            self.schedule(timer)
+
+    async def notify_timer(
+        self,
+        op: str,
+        timer_id: int,
+        author_id: Optional[int],
+        event: str,
+        expires: Optional[datetime.datetime] = None,
+    ) -> None:
+        payload = {
+            'op': op,
+            'id': timer_id,
+            'author_id': author_id,
+            'event': event,
+            'expires': expires.isoformat() if expires else None,
+            'origin': self._origin,
+        }
+        query = '''SELECT pg_notify($1, $2)'''
+        await self.bot.pool.execute(query, self.NOTIFY_CHANNEL, json.dumps(payload))
+
+    def schedule(self, timer: Timer) -> None:
+        """Put a timer in the heap, waking up the dispatcher if it is now the earliest one"""
+        if timer.id in self._scheduled:
+            return
+        self._scheduled[timer.id] = timer
+        heapq.heappush(self._heap, (timer.expires, timer.id))
+        if self._heap[0][1] == timer.id:
+            self._wakeup.set()
+
+    def unschedule(self, timer_id: int) -> None:
+        # The heap entry is skipped when it is popped
+        self._scheduled.pop(timer_id, None)
+
+    async def prefetch_timers(self) -> None:
+        """Load every timer that expires within the prefetch window into the heap"""
+        window_end = discord.utils.utcnow() + self.PREFETCH_WINDOW
+        # Moved before querying so timers created while the query runs are scheduled by create_timer
+        # or the notification handler, schedule ignores the ones the query returns as well
+        previous, self._window_end = self._window_end, window_end
+        query = '''SELECT * FROM timers WHERE expires < $1 ORDER BY expires'''
+        try:
+            records = await self.bot.pool.fetch(query, window_end)
+        except BaseException:
+            self._window_end = previous
+            raise
+        for record in records:
+            self.schedule(Timer(record=record))
+
+    def pop_due_timers(self, now: datetime.datetime) -> list[int]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, timer_id = heapq.heappop(self._heap)
+            if self._scheduled.pop(timer_id, None) is not None:
+                due.append(timer_id)
+        return due
+
+    async def call_timers(self, timer_ids: list[int]) -> None:
+        """Claim the timers from the database and dispatch their events."""
+        # Only the timers that were actually deleted are dispatched, so cancelled ones are skipped.
+        # Rows another process is already claiming are skipped instead of waited on, it dispatches them.
+        query = '''WITH due AS (
+                       SELECT id FROM timers
+                       WHERE id = ANY($1::bigint[])
+                       FOR UPDATE SKIP LOCKED
+                   )
+                   DELETE FROM timers USING due
+                   WHERE timers.id = due.id
+                   RETURNING timers.*'''
+        records = await self.bot.pool.fetch(query, timer_ids)
+        now = discord.utils.utcnow()
+        self.batch_size.observe(len(records))
+        for record in records:
+            timer = Timer(record=record)
+            self.dispatch_lag.observe((now - timer.expires).total_seconds())
+            self.bot.dispatch(f'{timer.event}_timer_complete', timer)
 
     async def dispatch_timers(self) -> None:
         await self.bot.wait_until_ready()
         try:
             while not self.bot.is_closed():
-                await self._have_data.wait()
-                # can only asyncio.sleep for up to ~48 days reliably
-                # so we're gonna cap it off at 40 days
-                # see: http://bugs.python.org/issue20493
-
-                # get the next active timer within 40 days
-                # if there is no timer, we wait until we have data
-                timer = self._current_timer = await self.get_active_timer(days=40)
-                if timer is None:
-                    self._have_data.clear()
-                    continue
-
                 now = discord.utils.utcnow()
+                if now >= self._window_end:
+                    await self.prefetch_timers()
+
+                # Everything that is due goes out in one batch
+                due = self.pop_due_timers(now)
+                self.heap_size.observe(len(self._scheduled))
+                if due:
+                    await self.call_timers(due)
+                    continue
 
-                if timer.expires >= now:
-                    to_sleep = (timer.expires - now).total_seconds()
-                    await asyncio.sleep(to_sleep)
+                wake_at = self._window_end
+                if self._heap and self._heap[0][0] < wake_at:
+                    wake_at = self._heap[0][0]
 
-                await self.call_timer(timer)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=(wake_at - now).total_seconds())
+                except asyncio.TimeoutError:
+                    pass
         except asyncio.CancelledError:
             raise
         except (OSError, discord.ConnectionClosed, asyncpg.PostgresConnectionError):
             # Just restart the task if we have a connection issue
+            # and refetch the window since the popped timers may not have gone out
+            self._window_end = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
             self._task.cancel()
             self._task = self.bot.loop.create_task(self.dispatch_timers())
         except Exception as e:
@@ -213,9 +535,20 @@ class Reminders(commands.Cog):
             await self.bot.owner.send(f'```py\n{"".join(tb)}```')
             raise
 
-    async def short_timer(self, seconds: float, timer: Timer) -> None:
+    async def short_timer(self, seconds: float, timer: Timer, key: str) -> None:
         await asyncio.sleep(seconds)
+        # Replayed timers can be overdue before the bot has logged in, nothing could be delivered then
+        await self.bot.wait_until_ready()
+        self.dispatch_lag.observe((discord.utils.utcnow() - timer.expires).total_seconds())
+        timer.journal_key = key
         self.bot.dispatch(f'{timer.event}_timer_complete', timer)
+        if timer.event not in self.JOURNAL_ACKNOWLEDGED_EVENTS:
+            self.journal.done(key)
+
+    def start_short_timer(self, seconds: float, timer: Timer, key: str) -> None:
+        task = self.bot.loop.create_task(self.short_timer(seconds, timer, key))
+        self._short_timers.add(task)
+        task.add_done_callback(self._short_timers.discard)
 
     async def create_timer(self, expires: datetime.datetime, event: str, *args: Any, **kwargs: Any) -> Timer:
         try:
@@ -228,29 +561,42 @@ class Reminders(commands.Cog):
         timer = Timer.temporary(event=event, args=args, kwargs=kwargs, expires=expires, created=now, timezone=tz_name)
         delta = (expires - now).total_seconds()
         if delta <= 60:
-            self.bot.loop.create_task(self.short_timer(delta, timer))
+            key = self.journal.add(timer)
+            self.start_short_timer(delta, timer, key)
             return timer
 
-        query = '''INSERT INTO timers (event, created, expires, extra, timezone)
-                   VALUES ($1, $2, $3, $4, $5) RETURNING id;'''
+        query = '''INSERT INTO timers (event, created, expires, extra, timezone, author_id)
+                   VALUES ($1, $2, $3, $4, $5, $6) RETURNING id;'''
 
-        row = await self.bot.pool.fetchrow(query, event, now, expires, {'args': args, 'kwargs': kwargs}, tz_name)
+        author_id = timer.author_id
+        row = await self.bot.pool.fetchrow(query, event, now, expires, {'args': args, 'kwargs': kwargs}, tz_name, author_id)
         timer.id = row['id']
+        self._autocomplete_cache.pop(author_id, None)
+        await self.notify_timer('create', timer.id, author_id, event, expires)
 
-        # only set if it is 40 days or less
-        if delta <= (60 * 60 * 24 * 40):
-            self._have_data.set()
-
-        # check if new timer expires earlier than current one
-        if self._current_timer and expires < self._current_timer.expires:
-            self._task.cancel()
-            self._task = self.bot.loop.create_task(self.dispatch_timers())
+        # Timers past the prefetch window are picked up by a later prefetch
+        if expires < self._window_end:
+            self.schedule(timer)
 
         return timer
 
     @commands.Cog.listener()
     async def on_reminder_timer_complete(self, timer: Timer) -> None:
+        start = self.bot.loop.time()
+        try:
+            await self.send_reminder(timer)
+        except Exception:
+            # Left in the journal so a short timer is tried again on the next load
+            log.exception('Failed to send reminder %r', timer)
+        else:
+            if timer.journal_key is not None:
+                self.journal.done(timer.journal_key)
+        finally:
+            self.handler_duration.observe(self.bot.loop.time() - start)
+
+    async def send_reminder(self, timer: Timer) -> None:
         author_id, channel_id, message = timer.args
+        self._autocomplete_cache.pop(author_id, None)
         dm_user = False
         try:
             channel = self.bot.get_channel(channel_id) or (await self.bot.fetch_channel(channel_id))
@@ -384,12 +730,12 @@ class Reminders(commands.Cog):
         query = """SELECT id, expires, extra #>> '{args,2}'
                    FROM timers
                    WHERE event = 'reminder'
-                   AND extra #>> '{args,0}' = $1
+                   AND author_id = $1
                    ORDER BY expires
                    LIMIT 10;
                 """
 
-        records = await self.bot.pool.fetch(query, str(ctx.author.id))
+        records = await self.bot.pool.fetch(query, ctx.author.id)
 
         if not records:
             return await ctx.send('You do not have any reminders set.')
@@ -414,38 +760,87 @@ class Reminders(commands.Cog):
         query = """DELETE FROM timers
                    WHERE id=$1
                    AND event = 'reminder'
-                   AND extra #>> '{args,0}' = $2;
+                   AND author_id = $2;
                 """
 
-        result = await self.bot.pool.execute(query, id, str(ctx.author.id))
+        result = await self.bot.pool.execute(query, id, ctx.author.id)
 
         if result == 'DELETE 0':
             return await ctx.send('Could not delete reminder with that ID. Are you sure you own that ID?\n'
                                   'You can see your reminders with `%remind list`')
 
-        # if the current timer is being deleted, restart the task
-        if self._current_timer and self._current_timer.id == id:
-            self._task.cancel()
-            self._task = self.bot.loop.create_task(self.dispatch_timers())
+        self.unschedule(id)
+        self._autocomplete_cache.pop(ctx.author.id, None)
+        await self.notify_timer('cancel', id, ctx.author.id, 'reminder')
 
         await ctx.send(f'Deleted reminder {id}', ephemeral=True)
 
+    @reminder.command(name='stats', with_app_command=False, hidden=True)
+    @commands.is_owner()
+    async def reminder_stats(self, ctx: Context):
+        """Shows how far behind the timer dispatcher is running"""
+        e = discord.Embed(title='Timer Dispatch', colour=discord.Colour.blurple())
+        for name, hist, unit in (
+            ('Dispatch lag', self.dispatch_lag, 's'),
+            ('Handler time', self.handler_duration, 's'),
+            ('Heap size', self.heap_size, ''),
+            ('Batch size', self.batch_size, ''),
+        ):
+            e.add_field(
+                name=name,
+                value=f'p50: {hist.quantile(0.5):g}{unit}\n'
+                      f'p99: {hist.quantile(0.99):g}{unit}\n'
+                      f'max: {hist.max:g}{unit}\n'
+                      f'count: {hist.count}',
+            )
+        e.set_footer(text=f'{len(self._scheduled)} timers in the heap, {len(self._short_timers)} short timers')
+        await ctx.send(embed=e)
+
     # Force a data check once a week
     # Checks every 6day 23hr 45min
-    # In case there is a timer coming up next week and no new timers triggered a check
+    # The dispatcher already prefetches every window, this is just a safety net
     @tasks.loop(hours=167.75)
     async def weekly_check(self):
-        self._have_data.set()
+        # Timers left over from downtime are expected on the first run
+        if self.weekly_check.current_loop != 0:
+            await self.report_overdue_timers()
+        self._window_end = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        self._wakeup.set()
+
+    @weekly_check.before_loop
+    async def before_weekly_check(self):
+        await self.bot.wait_until_ready()
+
+    async def report_overdue_timers(self) -> None:
+        """Tells the owner about any timers the dispatcher should have already sent"""
+        # Allow a minute for the batch that is currently going out
+        query = '''SELECT id, event, expires FROM timers
+                   WHERE expires < $1
+                   ORDER BY expires;'''
+        records = await self.bot.pool.fetch(query, discord.utils.utcnow() - datetime.timedelta(minutes=1))
+        if not records:
+            return
+
+        log.warning('Found %s overdue timers, the oldest expired %s', len(records), records[0]['expires'])
+        lines = [f'{r["id"]} ({r["event"]}): expired {time.human_timedelta(r["expires"])}' for r in records[:10]]
+        if len(records) > 10:
+            lines.append(f'...and {len(records) - 10} more')
+        owner = self.bot.owner
+        if owner is not None:
+            await owner.send(f'Found {len(records)} overdue timers\n' + '\n'.join(lines))
 
     @reminder_cancel.autocomplete('id')
     async def reminder_cancel_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
-        query = '''SELECT id, expires, extra #>> '{args,2}' 
-                   FROM timers 
-                   WHERE event = 'reminder' 
-                   AND extra #>> '{args,0}' = $1 
-                   ORDER BY expires 
-                   LIMIT 25;'''
-        reminders = await self.bot.pool.fetch(query, str(interaction.user.id))
+        reminders = self._autocomplete_cache.get(interaction.user.id)
+        if reminders is None:
+            query = '''SELECT id, expires, extra #>> '{args,2}'
+                       FROM timers
+                       WHERE event = 'reminder'
+                       AND author_id = $1
+                       ORDER BY expires
+                       LIMIT 25;'''
+            reminders = await self.bot.pool.fetch(query, interaction.user.id)
+            self._autocomplete_cache[interaction.user.id] = reminders
         formatted = []
         for _id, expires, message in reminders:
             message = 'No message...' if message == '…' else message
@@ -455,35 +850,84 @@ class Reminders(commands.Cog):
         keys = finder(current, reminder_mapping.keys())
         return [app_commands.Choice(name=k, value=str(reminder_mapping[k])) for k in keys[:25]]
 
+    def register_desktop(self, timer: Timer) -> None:
+        self._desktop_reminders.setdefault(timer.author_id, {})[timer.id] = timer
+
+    def unregister_desktop(self, user_id: int, timer_id: int) -> None:
+        pending = self._desktop_reminders.get(user_id)
+        if pending is not None:
+            pending.pop(timer_id, None)
+            if not pending:
+                del self._desktop_reminders[user_id]
+
     @commands.command()
     async def desktop(self, ctx: Context, *, reminder: str='…'):
         """Set a reminder that triggers next time you go online on your desktop client
         Reminder expires if not triggered after 7 days
         Example usage: %desktop check out this video https://youtu.be/D0q0QeQbw9U"""
         start = ctx.message.created_at
-        await ctx.message.add_reaction('<a:typing:559157048919457801>')
+        await ctx.message.add_reaction(TYPING_EMOJI)
+        timer = await self.create_timer(
+            start + self.DESKTOP_EXPIRY,
+            'desktop',
+            ctx.author.id,
+            ctx.channel.id,
+            reminder,
+            created=start,
+            message_id=ctx.message.id,
+            jump_url=ctx.message.jump_url,
+        )
+        self.register_desktop(timer)
+
+    @commands.Cog.listener()
+    async def on_presence_update(self, before: discord.Member, after: discord.Member):
+        # Runs for every presence update, so bail out before anything else for users without reminders
+        if after.id not in self._desktop_reminders:
+            return
+
+        if not ((before.desktop_status is not discord.Status.online and after.desktop_status is discord.Status.online)
+                or (before.desktop_status is discord.Status.offline and after.desktop_status is not discord.Status.offline)):
+            return
 
-        def check(before, after):
-            return before.id == ctx.author.id and \
-                   ((before.desktop_status is not discord.Status.online and after.desktop_status is discord.Status.online)
-                    or (before.desktop_status is discord.Status.offline and after.desktop_status is not discord.Status.offline))
+        # Popped before awaiting so the same update from other guilds doesn't trigger them again
+        pending = self._desktop_reminders.pop(after.id)
+        query = '''DELETE FROM timers
+                   WHERE id = ANY($1::bigint[])
+                   AND event = 'desktop'
+                   RETURNING *;'''
+        records = await self.bot.pool.fetch(query, list(pending))
+        for record in records:
+            timer = Timer(record=record)
+            self.unschedule(timer.id)
+            await self.notify_timer('cancel', timer.id, timer.author_id, timer.event)
+            await self.finish_desktop_reminder(timer, triggered=True)
 
+    @commands.Cog.listener()
+    async def on_desktop_timer_complete(self, timer: Timer):
+        self.unregister_desktop(timer.author_id, timer.id)
+        await self.finish_desktop_reminder(timer, triggered=False)
+
+    async def finish_desktop_reminder(self, timer: Timer, *, triggered: bool) -> None:
+        author_id, channel_id, reminder = timer.args
+        channel = self.bot.get_partial_messageable(channel_id)
+        message = channel.get_partial_message(timer.kwargs['message_id'])
+        tick = '<:greenTick:602811779835494410>' if triggered else '<:redTick:602811779474522113>'
         try:
-            await self.bot.wait_for('presence_update', check=check, timeout=604800)
-        except asyncio.TimeoutError:
-            await ctx.tick(False)
-        else:
-            await ctx.tick(True)
+            await message.add_reaction(tick)
+            await message.remove_reaction(TYPING_EMOJI, self.bot.user)
+        except discord.HTTPException:
+            pass
 
-            view = discord.ui.View()
-            view.add_item(discord.ui.Button(label='Go to original message', url=ctx.message.jump_url))
-            await ctx.send(f'{ctx.author.mention} desktop reminder from {time.human_timedelta(start)}: {reminder}',
-                           view=view)
-        finally:
-            try:
-                await ctx.message.remove_reaction('<a:typing:559157048919457801>', ctx.me)
-            except discord.HTTPException:
-                pass
+        if not triggered:
+            return
+
+        view = discord.ui.View()
+        view.add_item(discord.ui.Button(label='Go to original message', url=timer.kwargs['jump_url']))
+        try:
+            await channel.send(f'<@{author_id}> desktop reminder from {time.human_timedelta(timer.created_at)}: {reminder}',
+                               view=view)
+        except discord.HTTPException:
+            pass
 
 
 async def setup(bot: SnowflakeBot):
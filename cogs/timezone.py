@@ -1,17 +1,25 @@
 from __future__ import annotations
 
+import os
+import re
+import sys
+import bisect
+import json
 import asyncio
+import logging
+import pathlib
 import datetime
 import zoneinfo
-from typing import TYPE_CHECKING, NamedTuple, Optional, Union, Annotated
+from typing import TYPE_CHECKING, Iterable, NamedTuple, Optional, Union, Annotated
 
+import aiohttp
 import discord
 from discord import app_commands
 from discord.ext import commands
+from lru import LRU
 from lxml import etree
+from rapidfuzz import fuzz, process
 
-from utils.cache import cache
-from utils.fuzzy import finder
 from utils.time import UserFriendlyTime, FriendlyTimeResult, format_dt
 
 
@@ -19,6 +27,8 @@ if TYPE_CHECKING:
     from main import SnowflakeBot
     from utils.context import Context
 
+log = logging.getLogger(__name__)
+
 
 class CLDRDataEntry(NamedTuple):
     description: str
@@ -56,6 +66,70 @@ class TimeZone(NamedTuple):
         return zoneinfo.ZoneInfo(self.key)
 
 
+class TimezoneIndex:
+    """Search index over timezone labels, built once so a search doesn't rescan every name"""
+
+    NORMALISE = re.compile(r'[\W_]+')
+
+    def __init__(self, timezones: Iterable[TimeZone], *, limit: int = 25, cache_size: int = 4096):
+        self.timezones: list[TimeZone] = list(timezones)
+        self.limit: int = limit
+        self._choices: list[str] = [self.normalise(tz.label) for tz in self.timezones]
+
+        # Every word of every label onwards, sorted so all the entries starting with a query are one slice
+        prefixes: list[tuple[str, int]] = []
+        for index, choice in enumerate(self._choices):
+            start = 0
+            while start != -1:
+                prefixes.append((choice[start:], index))
+                start = choice.find(' ', start)
+                if start != -1:
+                    start += 1
+        prefixes.sort()
+        self._prefixes: list[str] = [prefix for prefix, _ in prefixes]
+        self._prefix_ids: list[int] = [index for _, index in prefixes]
+
+        self._cache: LRU = LRU(cache_size)  # normalised query: list[TimeZone]
+
+    @classmethod
+    def normalise(cls, text: str) -> str:
+        return cls.NORMALISE.sub(' ', text.casefold()).strip()
+
+    def search(self, query: str) -> list[TimeZone]:
+        query = self.normalise(query)
+        cached = self._cache.get(query)
+        if cached is not None:
+            return cached
+
+        results = self._prefix_search(query) or self._fuzzy_search(query)
+        self._cache[query] = results
+        return results
+
+    def _prefix_search(self, query: str) -> list[TimeZone]:
+        lo = bisect.bisect_left(self._prefixes, query)
+        hi = bisect.bisect_left(self._prefixes, query + '\uffff', lo)
+
+        # Matches at the start of the label beat ones at a later word, then shorter labels win
+        ranks: dict[int, tuple[int, int]] = {}
+        for i in range(lo, hi):
+            index = self._prefix_ids[i]
+            choice = self._choices[index]
+            rank = (len(self._prefixes[i]) != len(choice), len(choice))
+            if rank < ranks.get(index, (True, len(choice) + 1)):
+                ranks[index] = rank
+
+        best = sorted(ranks, key=ranks.__getitem__)[:self.limit]
+        return [self.timezones[index] for index in best]
+
+    def _fuzzy_search(self, query: str) -> list[TimeZone]:
+        # Nothing starts with the query, so it is most likely a typo.
+        # partial_ratio since the query is usually only the start of a name, and it is a lot cheaper than WRatio
+        matches = process.extract(
+            query, self._choices, scorer=fuzz.partial_ratio, processor=None, limit=self.limit, score_cutoff=70
+        )
+        return [self.timezones[index] for _, _, index in matches]
+
+
 class Timezone(commands.Cog):
 
     DEFAULT_POPULAR_TIMEZONE_IDS = (
@@ -99,96 +173,209 @@ class Timezone(commands.Cog):
         "brsao",  # America/Sao_Paulo
     )
 
+    STATIC_TIMEZONE_ALIASES = {
+        'Eastern Time': 'America/New_York',
+        'Central Time': 'America/Chicago',
+        'Mountain Time': 'America/Denver',
+        'Pacific Time': 'America/Los_Angeles',
+        # (Unfortunately) special case American timezone abbreviations
+        'EST': 'America/New_York',
+        'CST': 'America/Chicago',
+        'MST': 'America/Denver',
+        'PST': 'America/Los_Angeles',
+        'EDT': 'America/New_York',
+        'CDT': 'America/Chicago',
+        'MDT': 'America/Denver',
+        'PDT': 'America/Los_Angeles',
+    }
+
+    CLDR_URL = 'https://raw.githubusercontent.com/unicode-org/cldr/main/common/bcp47/timezone.xml'
+    # Bump this whenever the layout of the snapshot changes so old ones are ignored
+    CLDR_SNAPSHOT_VERSION = 1
+    CLDR_SNAPSHOT_PATH = pathlib.Path('./data/cldr_timezones.json')
+    CLDR_REFRESH_ATTEMPTS = 4
+
     def __init__(self, bot: SnowflakeBot):
         self.bot: SnowflakeBot = bot
         self.valid_timezones = zoneinfo.available_timezones()
-        self._timezone_aliases: dict[str, str] = {
-            'Eastern Time': 'America/New_York',
-            'Central Time': 'America/Chicago',
-            'Mountain Time': 'America/Denver',
-            'Pacific Time': 'America/Los_Angeles',
-            # (Unfortunately) special case American timezone abbreviations
-            'EST': 'America/New_York',
-            'CST': 'America/Chicago',
-            'MST': 'America/Denver',
-            'PST': 'America/Los_Angeles',
-            'EDT': 'America/New_York',
-            'CDT': 'America/Chicago',
-            'MDT': 'America/Denver',
-            'PDT': 'America/Los_Angeles',
-        }
+        self._timezone_aliases: dict[str, str] = dict(self.STATIC_TIMEZONE_ALIASES)
         self._default_timezones: list[app_commands.Choice[str]] = []
+        self._cldr_etag: Optional[str] = None
+        self._cldr_task: Optional[asyncio.Task] = None
+        self._identifier_index: TimezoneIndex = TimezoneIndex(TimeZone(label=k, key=k) for k in self.valid_timezones)
+        self._alias_index: TimezoneIndex = self.build_alias_index(self._timezone_aliases)
+        # {user_id: tz}, the whole timezones table. Names are interned since most users share a handful of zones
+        self._timezones: dict[int, str] = {}
+        self._zones: dict[str, Optional[zoneinfo.ZoneInfo]] = {}
 
     async def cog_load(self) -> None:
-        await self.parse_bcp47_timezones()
+        await self.load_timezones()
+        self.load_cldr_snapshot()
+        # The snapshot is good enough to start with, check for a newer one without holding up loading
+        self._cldr_task = self.bot.loop.create_task(self.refresh_cldr_timezones())
+
+    async def cog_unload(self) -> None:
+        if self._cldr_task is not None:
+            self._cldr_task.cancel()
+
+    async def load_timezones(self) -> None:
+        query = '''SELECT id, tz FROM timezones;'''
+        records = await self.bot.pool.fetch(query)
+        self._timezones = {record['id']: sys.intern(record['tz']) for record in records}
+
+    def load_cldr_snapshot(self) -> None:
+        """Load the CLDR aliases saved from the last download, if there is a usable one"""
+        try:
+            with self.CLDR_SNAPSHOT_PATH.open(encoding='utf-8') as fp:
+                snapshot = json.load(fp)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            log.warning('Ignoring corrupt CLDR timezone snapshot at %s', self.CLDR_SNAPSHOT_PATH)
+            return
 
-    async def parse_bcp47_timezones(self) -> None:
-        async with self.bot.session.get(
-            'https://raw.githubusercontent.com/unicode-org/cldr/main/common/bcp47/timezone.xml'
-        ) as resp:
-            if resp.status != 200:
+        if snapshot.get('version') != self.CLDR_SNAPSHOT_VERSION:
+            return
+
+        self.swap_cldr_timezones(snapshot['aliases'], snapshot['defaults'])
+        self._cldr_etag = snapshot.get('etag')
+
+    def save_cldr_snapshot(self, aliases: dict[str, str], defaults: list[tuple[str, str]]) -> None:
+        snapshot = {
+            'version': self.CLDR_SNAPSHOT_VERSION,
+            'etag': self._cldr_etag,
+            'aliases': aliases,
+            'defaults': defaults,
+        }
+        self.CLDR_SNAPSHOT_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.CLDR_SNAPSHOT_PATH.with_suffix('.tmp')
+        with tmp.open('w', encoding='utf-8') as fp:
+            json.dump(snapshot, fp, separators=(',', ':'))
+        os.replace(tmp, self.CLDR_SNAPSHOT_PATH)
+
+    def swap_cldr_timezones(self, aliases: dict[str, str], defaults: list[tuple[str, str]]) -> None:
+        # Built off to the side and then assigned, so lookups never see a half filled table
+        timezone_aliases = {**self.STATIC_TIMEZONE_ALIASES, **aliases}
+        self._alias_index = self.build_alias_index(timezone_aliases)
+        self._timezone_aliases = timezone_aliases
+        self._default_timezones = [app_commands.Choice(name=name, value=value) for name, value in defaults]
+
+    @staticmethod
+    def build_alias_index(aliases: dict[str, str]) -> TimezoneIndex:
+        return TimezoneIndex(TimeZone(label=label, key=key) for label, key in aliases.items())
+
+    async def refresh_cldr_timezones(self) -> None:
+        """Download the CLDR timezone data if it changed since the snapshot was taken, retrying with backoff"""
+        for attempt in range(self.CLDR_REFRESH_ATTEMPTS):
+            try:
+                await self.fetch_cldr_timezones()
+            except (aiohttp.ClientError, asyncio.TimeoutError, etree.LxmlError, KeyError, ValueError):
+                log.warning('Could not refresh the CLDR timezone data, using the snapshot', exc_info=True)
+            else:
                 return
+            if attempt + 1 < self.CLDR_REFRESH_ATTEMPTS:
+                await asyncio.sleep(60 * 2 ** attempt)
+
+    async def fetch_cldr_timezones(self) -> None:
+        headers = {}
+        # Without a loaded table the etag is useless, we need the full body
+        if self._cldr_etag is not None and self._default_timezones:
+            headers['If-None-Match'] = self._cldr_etag
+
+        async with self.bot.session.get(self.CLDR_URL, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+            if resp.status == 304:
+                return
+            if resp.status != 200:
+                raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status, message=resp.reason or '')
+            data = await resp.read()
+            etag = resp.headers.get('ETag')
+
+        aliases, defaults = await asyncio.to_thread(self.parse_bcp47_timezones, data)
+        self.swap_cldr_timezones(aliases, defaults)
+        self._cldr_etag = etag
+        await asyncio.to_thread(self.save_cldr_snapshot, aliases, defaults)
+
+    def parse_bcp47_timezones(self, data: bytes) -> tuple[dict[str, str], list[tuple[str, str]]]:
+        parser = etree.XMLParser(ns_clean=True, recover=True, encoding='utf-8')
+        tree = etree.fromstring(data, parser=parser)
+        if tree is None:
+            # recover=True hands back nothing instead of raising for some broken documents
+            raise ValueError('The CLDR timezone document is empty or malformed')
+
+        # Build a temporary dictionary to resolve "preferred" mappings
+        entries: dict[str, CLDRDataEntry] = {
+            node.attrib['name']: CLDRDataEntry(
+                description=node.attrib['description'],
+                aliases=node.get('alias', 'Etc/Unknown').split(' '),
+                deprecated=node.get('deprecated', 'false') == 'true',
+                preferred=node.get('preferred'),
+            )
+            for node in tree.iter('type')
+            # Filter the Etc/ entries (except UTC)
+            if not node.attrib['name'].startswith(('utcw', 'utce', 'unk'))
+            and not node.attrib['description'].startswith('POSIX')
+        }
+
+        aliases: dict[str, str] = {}
+        for entry in entries.values():
+            # These use the first entry in the alias list as the "canonical" name to use when mapping the
+            # timezone to the IANA database.
+            # The CLDR database is not particularly correct when it comes to these, but neither is the IANA database.
+            # It turns out the notion of a "canonical" name is a bit of a mess. This works fine for users where
+            # this is only used for display purposes, but it's not ideal.
+            if entry.preferred is not None:
+                preferred = entries.get(entry.preferred)
+                if preferred is not None:
+                    aliases[entry.description] = preferred.aliases[0]
+            else:
+                aliases[entry.description] = entry.aliases[0]
+
+        defaults: list[tuple[str, str]] = []
+        for key in self.DEFAULT_POPULAR_TIMEZONE_IDS:
+            entry = entries.get(key)
+            if entry is not None:
+                defaults.append((entry.description, entry.aliases[0]))
+
+        if not aliases:
+            # A truncated download, don't replace a working table with an empty one
+            raise ValueError('The CLDR timezone document has no timezones')
+        return aliases, defaults
 
-            parser = etree.XMLParser(ns_clean=True, recover=True, encoding='utf-8')
-            tree = etree.fromstring(await resp.read(), parser=parser)
-
-            # Build a temporary dictionary to resolve "preferred" mappings
-            entries: dict[str, CLDRDataEntry] = {
-                node.attrib['name']: CLDRDataEntry(
-                    description=node.attrib['description'],
-                    aliases=node.get('alias', 'Etc/Unknown').split(' '),
-                    deprecated=node.get('deprecated', 'false') == 'true',
-                    preferred=node.get('preferred'),
-                )
-                for node in tree.iter('type')
-                # Filter the Etc/ entries (except UTC)
-                if not node.attrib['name'].startswith(('utcw', 'utce', 'unk'))
-                and not node.attrib['description'].startswith('POSIX')
-            }
-
-            for entry in entries.values():
-                # These use the first entry in the alias list as the "canonical" name to use when mapping the
-                # timezone to the IANA database.
-                # The CLDR database is not particularly correct when it comes to these, but neither is the IANA database.
-                # It turns out the notion of a "canonical" name is a bit of a mess. This works fine for users where
-                # this is only used for display purposes, but it's not ideal.
-                if entry.preferred is not None:
-                    preferred = entries.get(entry.preferred)
-                    if preferred is not None:
-                        self._timezone_aliases[entry.description] = preferred.aliases[0]
-                else:
-                    self._timezone_aliases[entry.description] = entry.aliases[0]
-
-            for key in self.DEFAULT_POPULAR_TIMEZONE_IDS:
-                entry = entries.get(key)
-                if entry is not None:
-                    self._default_timezones.append(app_commands.Choice(name=entry.description, value=entry.aliases[0]))
-
-    @cache(maxsize=10)
     async def get_timezone(self, user_id: int) -> Optional[str]:
         """Get the timezone for a user, if it exists."""
-        query = '''SELECT tz FROM timezones WHERE id = $1;'''
-        record = await self.bot.pool.fetchrow(query, user_id)
-        return record['tz'] if record else None
+        return self._timezones.get(user_id)
 
-    async def get_tzinfo(self, user_id: int) -> datetime.tzinfo:
-        tz = await self.get_timezone(user_id)
-        if tz is None:
-            return datetime.UTC
+    def get_timezones(self, user_ids: Iterable[int]) -> dict[int, str]:
+        """Get the timezones for many users at once, users without one are left out."""
+        timezones = self._timezones
+        return {user_id: timezones[user_id] for user_id in user_ids if user_id in timezones}
+
+    def get_zone(self, tz: str) -> Optional[zoneinfo.ZoneInfo]:
+        try:
+            return self._zones[tz]
+        except KeyError:
+            pass
 
         try:
-            return zoneinfo.ZoneInfo(tz)
-        except zoneinfo.ZoneInfoNotFoundError:
+            zone = zoneinfo.ZoneInfo(tz)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            zone = None
+        self._zones[tz] = zone
+        return zone
+
+    async def get_tzinfo(self, user_id: int) -> datetime.tzinfo:
+        tz = self._timezones.get(user_id)
+        if tz is None:
             return datetime.UTC
+        return self.get_zone(tz) or datetime.UTC
 
     def find_timezones(self, query: str) -> list[TimeZone]:
         # A bit hacky, but if '/' is in the query then it's looking for a raw identifier
         # otherwise it's looking for a CLDR alias
         if '/' in query:
-            return [TimeZone(key=a, label=a) for a in finder(query, self.valid_timezones)]
+            return self._identifier_index.search(query)
 
-        keys = finder(query, self._timezone_aliases.keys())
-        return [TimeZone(label=k, key=self._timezone_aliases[k]) for k in keys]
+        return self._alias_index.search(query)
 
     @commands.hybrid_group(case_insensitive=True, aliases=['tz', 'time'])
     async def timezone(self, ctx: Context):
@@ -204,7 +391,7 @@ class Timezone(commands.Cog):
             await ctx.send(f'No timezone found for {user.mention}', allowed_mentions=discord.AllowedMentions.none())
             return
 
-        time = discord.utils.utcnow().astimezone(zoneinfo.ZoneInfo(tz)).strftime('%Y-%m-%d %H:%M (%I:%M %p)')
+        time = discord.utils.utcnow().astimezone(await self.get_tzinfo(user.id)).strftime('%Y-%m-%d %H:%M (%I:%M %p)')
         if user.id == ctx.author.id:
             msg = await ctx.send(f'Your timezone is set to: {tz}. Your current time is {time}')
             await asyncio.sleep(5)
@@ -232,7 +419,7 @@ class Timezone(commands.Cog):
                    SET tz=$2;'''
         await self.bot.pool.execute(query, ctx.author.id, timezone.key)
 
-        self.get_timezone.invalidate(self, ctx.author.id)
+        self._timezones[ctx.author.id] = sys.intern(timezone.key)
 
         await ctx.send(f'Your timezone is now set to: {timezone.label} (IANA ID: {timezone.key})', ephemeral=True)
 
@@ -259,7 +446,7 @@ class Timezone(commands.Cog):
         query = '''DELETE FROM timezones
                    WHERE id = $1;'''
         await self.bot.pool.execute(query, ctx.author.id)
-        self.get_timezone.invalidate(self, ctx.author.id)
+        self._timezones.pop(ctx.author.id, None)
         await ctx.send('Your timezone has been removed', ephemeral=True)
 
     @timezone_set.autocomplete('timezone')
@@ -1,25 +1,486 @@
+import os
+import json
+import bisect
+import heapq
+import random
+import itertools
+import hashlib
 import logging
 import asyncio
-import traceback
+import pathlib
 from io import BytesIO
-from collections import defaultdict
+from array import array
+from collections import defaultdict, deque
 from datetime import datetime, timedelta
 
-import aiohttp
 import asyncpg
 import discord
 import humanize
 from discord.ext import commands
 from asyncpg import UniqueViolationError
+from utils import metrics
 from utils.global_utils import make_naive
 from utils.converters import CaseInsensitiveVoiceChannel
 
 
 logger = logging.getLogger(__name__)
 
+
+class HistoryWriter:
+    """Buffers history rows in memory and writes them out in bulk with COPY
+
+    Flushes once max_rows rows are waiting or max_delay seconds after the first one, whichever comes first.
+    """
+
+    COLUMNS = {
+        'nick_changes': ('id', 'guild', 'name', 'changed_at'),
+        'name_changes': ('id', 'name', 'discrim', 'changed_at'),
+        'global_name_changes': ('id', 'name', 'changed_at'),
+        'avatar_changes': ('id', 'hash', 'url', 'message', 'changed_at'),
+    }
+
+    def __init__(self, bot, *, max_rows=500, max_delay=2.0, max_backlog=50000):
+        self.bot = bot
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        # Rows kept for a retry when the database is down, past this they are dropped
+        self.max_backlog = max_backlog
+        self._buffers = {table: [] for table in self.COLUMNS}
+        self._pending = 0
+        self._timer = None
+        self._lock = asyncio.Lock()
+        self.dropped = 0
+        self.flush_latency = metrics.histogram('tracker_flush_seconds', 'Time taken to write a batch of history rows')
+        self.buffer_depth = metrics.histogram(
+            'tracker_buffer_rows', 'History rows waiting when a flush starts',
+            buckets=(1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000),
+        )
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def add(self, table, row):
+        self._buffers[table].append(row)
+        self._pending += 1
+        if self._pending >= self.max_rows:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.max_delay)
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self.bot.loop.call_later(delay, lambda: self.bot.loop.create_task(self.flush()))
+
+    async def flush(self):
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending:
+                return
+
+            buffers, self._buffers = self._buffers, {table: [] for table in self.COLUMNS}
+            self.buffer_depth.observe(self._pending)
+            self._pending = 0
+
+            start = self.bot.loop.time()
+            try:
+                async with self.bot.pool.acquire() as con, con.transaction():
+                    for table, rows in buffers.items():
+                        if rows:
+                            await con.copy_records_to_table(table, records=rows, columns=self.COLUMNS[table])
+            except Exception as e:
+                if self.is_connection_error(e):
+                    logger.warning('Could not reach the database, keeping %s history rows: %s',
+                                   sum(map(len, buffers.values())), e)
+                    self._requeue(buffers)
+                else:
+                    # Something in the batch is bad, write what can be written and drop the rest
+                    logger.warning('Failed to write a batch of history rows, retrying them one by one: %s', e)
+                    await self._write_rows(buffers)
+            finally:
+                self.flush_latency.observe(self.bot.loop.time() - start)
+
+    @staticmethod
+    def is_connection_error(error):
+        # asyncpg's client side DataError is an InterfaceError too, but retrying it would never succeed
+        if isinstance(error, ValueError):
+            return False
+        return isinstance(error, (OSError, asyncio.TimeoutError, asyncpg.InterfaceError, asyncpg.PostgresConnectionError))
+
+    async def _write_rows(self, buffers):
+        remaining = {table: deque(rows) for table, rows in buffers.items()}
+        try:
+            async with self.bot.pool.acquire() as con:
+                for table, rows in remaining.items():
+                    columns = self.COLUMNS[table]
+                    query = f'INSERT INTO {table}({", ".join(columns)}) ' \
+                            f'VALUES({", ".join(f"${i}" for i in range(1, len(columns) + 1))});'
+                    while rows:
+                        try:
+                            await con.execute(query, *rows[0])
+                        except Exception as e:
+                            if self.is_connection_error(e):
+                                raise
+                            logger.error('Dropping history row %r for %s: %s', rows[0], table, e)
+                            self.dropped += 1
+                        rows.popleft()
+        except Exception as e:
+            if not self.is_connection_error(e):
+                raise
+            logger.warning('Lost the database connection, keeping %s history rows: %s',
+                           sum(map(len, remaining.values())), e)
+            self._requeue({table: list(rows) for table, rows in remaining.items()})
+
+    def _requeue(self, buffers):
+        for table, rows in buffers.items():
+            room = self.max_backlog - self._pending
+            if room <= 0:
+                self.dropped += len(rows)
+                continue
+            self.dropped += max(0, len(rows) - room)
+            # Older rows go first so the history stays in order
+            self._buffers[table][:0] = rows[:room]
+            self._pending += min(len(rows), room)
+        if self._pending:
+            self._schedule(self.max_delay)
+
+    async def close(self):
+        await self.flush()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+class KnownUsers:
+    """Set of the user ids that already have history in a table, at 8 bytes per id
+
+    Loaded ids are kept in a sorted array and searched with bisect, ids added afterwards
+    go into a small set that is merged into the array once it grows.
+    """
+
+    def __init__(self, merge_at=4096):
+        self.merge_at = merge_at
+        self.loaded = False
+        self._ids = array('q')
+        self._added = set()
+
+    def __contains__(self, user_id):
+        return user_id in self._added or self._in_ids(user_id)
+
+    def _in_ids(self, user_id):
+        i = bisect.bisect_left(self._ids, user_id)
+        return i < len(self._ids) and self._ids[i] == user_id
+
+    def __len__(self):
+        return len(self._ids) + len(self._added)
+
+    def add(self, user_id):
+        if user_id not in self:
+            self._added.add(user_id)
+            # Until loading finishes the array is replaced wholesale, so everything stays in the set
+            if self.loaded and len(self._added) >= self.merge_at:
+                self._merge()
+
+    def update(self, user_ids):
+        for user_id in user_ids:
+            self.add(user_id)
+
+    def _merge(self):
+        # Added ids are never in the array already, so a linear merge of the two sorted runs is enough
+        self._ids = array('q', heapq.merge(self._ids, sorted(self._added)))
+        self._added.clear()
+
+    async def load(self, pool, table):
+        """Streams the distinct ids of the table in order, ids added in the meantime are kept"""
+        ids = array('q')
+        async with pool.acquire() as con, con.transaction():
+            async for record in con.cursor(f'SELECT DISTINCT id FROM {table} ORDER BY id;', prefetch=10000):
+                ids.append(record['id'])
+        self._ids = ids
+        self._added = {user_id for user_id in self._added if not self._in_ids(user_id)}
+        self.loaded = True
+        if len(self._added) >= self.merge_at:
+            self._merge()
+
+
+class AvatarBacklog:
+    """Append-only journal of the avatars waiting to be archived, so a restart doesn't lose them
+
+    Every line either adds a user's avatar hash or marks it as done, it is compacted when replayed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = None
+
+    def replay(self):
+        """Returns the (user id, avatar hash) pairs that were never archived"""
+        entries = {}
+        try:
+            with self.path.open(encoding='utf-8') as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A write that was cut off
+                        continue
+                    key = (entry['id'], entry['hash'])
+                    if entry['op'] == 'add':
+                        entries[key] = entry
+                    else:
+                        entries.pop(key, None)
+        except FileNotFoundError:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp = self.path.with_suffix('.tmp')
+        with tmp.open('w', encoding='utf-8') as fp:
+            for entry in entries.values():
+                fp.write(json.dumps(entry) + '\n')
+        os.replace(tmp, self.path)
+        self._fp = self.path.open('a', encoding='utf-8')
+        return list(entries)
+
+    def _write(self, entry):
+        if self._fp is None:
+            return
+        self._fp.write(json.dumps(entry) + '\n')
+        self._fp.flush()
+
+    def add(self, user_id, _hash):
+        self._write({'op': 'add', 'id': user_id, 'hash': _hash})
+
+    def done(self, user_id, _hash):
+        self._write({'op': 'done', 'id': user_id, 'hash': _hash})
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+class AvatarArchiver:
+    """Uploads avatars to the archive channel from a fixed pool of workers
+
+    Uploads go as fast as the webhook's rate limit allows, failures are retried with backoff
+    and anything still queued is kept in the backlog for the next start.
+    Someone waiting on an avatar goes ahead of the bulk archiving, which is limited to max_queued at a time.
+    """
+
+    ON_DEMAND, BULK = 0, 1
+
+    GUILD_ID = 557306479191916555
+    CHANNEL_ID = 703171905435467956
+    # Tried in order until one fits under the upload limit, animated avatars fall back to a still frame
+    ANIMATED_FORMATS = (('gif', 1024), ('gif', 512), ('gif', 256), ('png', 1024), ('png', 512))
+    STATIC_FORMATS = (('png', 1024), ('png', 512), ('png', 256), ('png', 128))
+
+    def __init__(self, bot, *, workers=3, max_attempts=5, max_queued=500,
+                 path=pathlib.Path('./data/avatar_backlog.journal')):
+        self.bot = bot
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backlog = AvatarBacklog(path)
+        # (priority, order, user, asset, attempt)
+        self._queue = asyncio.PriorityQueue()
+        self._order = itertools.count()
+        # Bulk producers wait on this, a slot is given back once their avatar is done with
+        self._bulk_slots = asyncio.Semaphore(max_queued)
+        # {(user_id, hash): future}, also stops the same avatar being queued twice
+        self._pending = {}
+        self._in_progress = set()
+        self._tasks = []
+        self._webhook = None
+        self._webhook_lock = asyncio.Lock()
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def start(self):
+        self._tasks = [self.bot.loop.create_task(self.worker()) for _ in range(self.workers)]
+        self._tasks.append(self.bot.loop.create_task(self.restore_backlog()))
+
+    async def restore_backlog(self):
+        entries = self.backlog.replay()
+        # Users are only cached once the bot has connected
+        await self.bot.wait_until_ready()
+        for user_id, _hash in entries:
+            user = self.bot.get_user(user_id)
+            if user is None:
+                try:
+                    user = await self.bot.fetch_user(user_id)
+                except discord.NotFound:
+                    self.backlog.done(user_id, _hash)
+                    continue
+                except discord.HTTPException as e:
+                    # Kept in the backlog for the next start
+                    logger.warning('Could not fetch %s to archive their avatar: %s', user_id, e)
+                    continue
+            if user.avatar is None or user.avatar.key != _hash:
+                # Changed since, the current one is picked up by the startup reconciliation
+                self.backlog.done(user_id, _hash)
+                continue
+            await self.enqueue(user, journal=False)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Whoever is still waiting gets nothing, the avatars stay in the backlog for the next start
+        for key in list(self._pending):
+            self._resolve(key, None)
+        self.backlog.close()
+
+    def _track(self, user, journal):
+        key = (user.id, user.avatar.key)
+        future = self._pending.get(key)
+        if future is not None:
+            return future, False
+        future = self._pending[key] = self.bot.loop.create_future()
+        if journal:
+            self.backlog.add(*key)
+        return future, True
+
+    def _put(self, priority, user, asset, attempt=0):
+        self._queue.put_nowait((priority, next(self._order), user, asset, attempt))
+
+    async def enqueue(self, user, *, journal=True):
+        """Queues the user's current avatar for archiving, waiting while the bulk queue is full"""
+        future, new = self._track(user, journal)
+        if new:
+            await self._bulk_slots.acquire()
+            self._put(self.BULK, user, user.avatar)
+        return future
+
+    def request(self, user):
+        """Archives the user's avatar ahead of the bulk queue, the future resolves to the url or None if it failed"""
+        future, _ = self._track(user, True)
+        if (user.id, user.avatar.key) not in self._in_progress:
+            # Already queued in bulk is fine, whichever copy is picked up second is skipped
+            self._put(self.ON_DEMAND, user, user.avatar)
+        return future
+
+    async def worker(self):
+        while True:
+            priority, _, user, asset, attempt = await self._queue.get()
+            key = (user.id, asset.key)
+            if key not in self._pending or key in self._in_progress:
+                # Archived or being archived through its other queue entry
+                if priority == self.BULK:
+                    self._bulk_slots.release()
+                continue
+
+            self._in_progress.add(key)
+            try:
+                url = await self.archive(user, asset)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    # Left in the backlog so it is tried again on the next start
+                    logger.warning('Giving up on archiving the avatar of %s (%s) for now: %s', user, user.id, e)
+                    self._resolve(key, None)
+                else:
+                    delay = min(300, 5 * 2 ** attempt) + random.uniform(0, 1)
+                    logger.info('Archiving the avatar of %s (%s) failed, retrying in %.0fs: %s', user, user.id, delay, e)
+                    # Keeps its bulk slot until it is done with
+                    self.bot.loop.call_later(delay, self._put, priority, user, asset, attempt)
+                    continue
+            else:
+                self.backlog.done(*key)
+                self._resolve(key, url)
+            finally:
+                self._in_progress.discard(key)
+
+            if priority == self.BULK:
+                self._bulk_slots.release()
+
+    def _resolve(self, key, result):
+        future = self._pending.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    async def get_webhook(self, *, refresh=False):
+        async with self._webhook_lock:
+            if self._webhook is None or refresh:
+                guild = self.bot.get_guild(self.GUILD_ID)
+                self._webhook = guild and discord.utils.get(await guild.webhooks(), channel_id=self.CHANNEL_ID)
+            return self._webhook
+
+    async def fetch(self, asset):
+        """Downloads the largest version of the avatar that fits under the archive's upload limit"""
+        guild = self.bot.get_guild(self.GUILD_ID)
+        limit = guild.filesize_limit if guild is not None else discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES
+        formats = self.ANIMATED_FORMATS if asset.is_animated() else self.STATIC_FORMATS
+        for fmt, size in formats:
+            data = await asset.replace(format=fmt, size=size).read()
+            if len(data) <= limit:
+                return data, fmt
+        raise ValueError(f'No format of {asset.url} fits in {limit} bytes')
+
+    async def upload(self, user, data, filename):
+        webhook = await self.get_webhook()
+        if webhook is None:
+            return await self.bot.get_channel(self.CHANNEL_ID).send(content=user.id, file=discord.File(BytesIO(data), filename=filename))
+        try:
+            return await webhook.send(content=user.id, file=discord.File(BytesIO(data), filename=filename),
+                                      wait=True, username=filename.partition('.')[0])
+        except discord.NotFound:
+            # The webhook was deleted, look it up again once
+            webhook = await self.get_webhook(refresh=True)
+            if webhook is None:
+                raise
+            return await webhook.send(content=user.id, file=discord.File(BytesIO(data), filename=filename),
+                                      wait=True, username=filename.partition('.')[0])
+
+    async def find_archived(self, asset):
+        """Looks for an archived copy of the avatar, first by its discord hash and then by its content"""
+        query = '''SELECT url, message FROM avatar_changes
+                   WHERE hash = $1 AND message IS NOT NULL
+                   LIMIT 1;'''
+        record = await self.bot.pool.fetchrow(query, asset.key)
+        if record is not None:
+            return record['url'], record['message'], None, None
+
+        data, fmt = await self.fetch(asset)
+        content_hash = hashlib.sha256(data).digest()
+        query = '''SELECT url, message FROM avatar_archive WHERE content_hash = $1;'''
+        record = await self.bot.pool.fetchrow(query, content_hash)
+        if record is not None:
+            return record['url'], record['message'], None, None
+        return None, None, content_hash, (data, fmt)
+
+    async def archive(self, user, asset):
+        url, message_id, content_hash, download = await self.find_archived(asset)
+        if url is None:
+            data, fmt = download
+            msg = await self.upload(user, data, f'{asset.key}.{fmt}')
+            url, message_id = msg.attachments[0].url, msg.id
+            query = '''INSERT INTO avatar_archive(content_hash, url, message)
+                       VALUES($1, $2, $3)
+                       ON CONFLICT (content_hash) DO NOTHING;'''
+            await self.bot.pool.execute(query, content_hash, url, message_id)
+
+        query = '''INSERT INTO avatar_changes(id, hash, url, message, changed_at)
+                   VALUES($1, $2, $3, $4, $5);'''
+        await self.bot.pool.execute(query, user.id, asset.key, url, message_id, datetime.utcnow())
+        return url
+
+
 class Tracker(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.history = HistoryWriter(bot)
+        self.archiver = AvatarArchiver(bot)
+        # Users that already have a name or avatar logged, saves querying on every join
+        self.known_names = KnownUsers()
+        self.known_avatars = KnownUsers()
+        self.bot.loop.create_task(self.load_known_users())
         self.bot.loop.create_task(self.add_join_dates())
         self.bot.loop.create_task(self.add_avatar())
         self.bot.loop.create_task(self.add_names())
@@ -33,85 +494,110 @@ class Tracker(commands.Cog):
                                       4: 'red',
                                       5: 'pink'}
 
+    async def cog_load(self):
+        self.archiver.start()
+
+    async def cog_unload(self):
+        await self.history.close()
+        await self.archiver.close()
+
+    async def load_known_users(self):
+        await self.known_names.load(self.bot.pool, 'name_changes')
+        await self.known_avatars.load(self.bot.pool, 'avatar_changes')
+        print(f'Loaded {len(self.known_names)} users with names and {len(self.known_avatars)} with avatars')
+
+    async def has_history(self, known, table, user_id):
+        if known.loaded:
+            return user_id in known
+        # Still loading, ask the database like before
+        record = await self.bot.pool.fetchrow(f'SELECT 1 FROM {table} WHERE id = $1 LIMIT 1;', user_id)
+        return record is not None
+
     async def add_join_dates(self):
         await self.bot.wait_until_ready()
-        query = '''SELECT guild, "user" FROM first_join'''
-        records = await self.bot.pool.fetch(query)
-        data = {(record['guild'], record['user']) for record in records}
-        new = 0
-        for guild in self.bot.guilds:
-            for member in guild.members:
-                if (guild.id, member.id) not in data:
-                    query = '''INSERT INTO first_join(guild, "user", time)
-                           VALUES($1, $2, $3);'''
-                    join_time = make_naive(member.joined_at or discord.utils.utcnow())
-                    try:
-                        await self.bot.pool.execute(query, member.guild.id, member.id, join_time)
-                    except Exception:
-                        traceback.print_exc()
-                    else:
-                        new += 1
+        new = await self.reconcile_join_dates(member for guild in self.bot.guilds for member in guild.members)
         print(f'Added {new} new members\' join date')
 
+    async def reconcile_join_dates(self, members) -> int:
+        """Inserts the join date of every member that doesn't have one yet, returns how many were added"""
+        now = discord.utils.utcnow()
+        records = ((m.guild.id, m.id, make_naive(m.joined_at or now)) for m in members)
+        async with self.bot.pool.acquire() as con, con.transaction():
+            await con.execute('''CREATE TEMPORARY TABLE roster_join_dates (
+                                     guild BIGINT, "user" BIGINT, time TIMESTAMP
+                                 ) ON COMMIT DROP;''')
+            await con.copy_records_to_table('roster_join_dates', records=records)
+            query = '''INSERT INTO first_join(guild, "user", time)
+                       SELECT r.guild, r."user", r.time FROM roster_join_dates r
+                       WHERE NOT EXISTS (
+                           SELECT 1 FROM first_join f WHERE f.guild = r.guild AND f."user" = r."user"
+                       )
+                       ON CONFLICT DO NOTHING;'''
+            status = await con.execute(query)
+        return int(status.split()[-1])
+
     async def add_avatar(self):
         await self.bot.wait_until_ready()
-        query = '''SELECT id, hash FROM avatar_changes'''
-        records = await self.bot.pool.fetch(query)
-        data = {(record['id'], record['hash']) for record in records}
-        new = 0
+        users = {}
         for user in self.bot.users:
             if not user.avatar:
                 _hash = self._default_avatar_names.get(int(user.display_avatar.key))
                 if _hash is None:
                     print(f'Unknown default avatar: {user.display_avatar.key} | {user.display_avatar}')
                     continue
-
             else:
                 _hash = user.avatar.key
-
-            if (user.id, _hash) not in data:
-                await self.log_avatar(user)
-                new += 1
-        print(f'Added {new} untracked avatars')
+            users[user.id] = (user, _hash)
+
+        # Only the users whose current avatar was never logged come back, those still need uploading
+        async with self.bot.pool.acquire() as con, con.transaction():
+            await con.execute('''CREATE TEMPORARY TABLE roster_avatars (
+                                     id BIGINT, hash TEXT
+                                 ) ON COMMIT DROP;''')
+            await con.copy_records_to_table('roster_avatars',
+                                            records=((user_id, _hash) for user_id, (_, _hash) in users.items()))
+            query = '''SELECT r.id FROM roster_avatars r
+                       WHERE NOT EXISTS (
+                           SELECT 1 FROM avatar_changes a WHERE a.id = r.id AND a.hash = r.hash
+                       );'''
+            missing = await con.fetch(query)
+
+        for record in missing:
+            await self.queue_avatar(users[record['id']][0])
+        self.known_avatars.update(users)
+        print(f'Added {len(missing)} untracked avatars')
 
     async def add_names(self):
         await self.bot.wait_until_ready()
-        name_data = '''SELECT id, name, discrim FROM name_changes;'''
-        name_records = await self.bot.pool.fetch(name_data)
-        name_data = {(record['id'], record['name'], record['discrim']) for record in name_records}
-        new_name = 0
-
-        global_name_data = '''SELECT id, name FROM global_name_changes;'''
-        global_name_records = await self.bot.pool.fetch(global_name_data)
-        global_name_data = {(record['id'], record['name']) for record in global_name_records}
+        now = datetime.utcnow()
+        users = list(self.bot.users)
+        async with self.bot.pool.acquire() as con, con.transaction():
+            await con.execute('''CREATE TEMPORARY TABLE roster_names (
+                                     id BIGINT, name TEXT, discrim TEXT, global_name TEXT
+                                 ) ON COMMIT DROP;''')
+            records = ((u.id, u.name, None if u.discriminator == '0' else u.discriminator, u.global_name) for u in users)
+            await con.copy_records_to_table('roster_names', records=records)
 
-        new_global_name = 0
-        for user in self.bot.users:
-            if user.discriminator != '0':
-                if (user.id, user.name, user.discriminator) not in name_data:
-                    await self.log_username(user)
-                    new_name += 1
-            else:
-                if (user.id, user.name, None) not in name_data:
-                    await self.log_username(user)
-                    new_name += 1
-            if (user.id, user.global_name) not in global_name_data:
-                await self.log_global_name(user)
-                new_global_name += 1
+            query = '''INSERT INTO name_changes(id, name, discrim, changed_at)
+                       SELECT r.id, r.name, r.discrim, $1 FROM roster_names r
+                       WHERE NOT EXISTS (
+                           SELECT 1 FROM name_changes n
+                           WHERE n.id = r.id AND n.name = r.name AND n.discrim IS NOT DISTINCT FROM r.discrim
+                       );'''
+            new_name = int((await con.execute(query, now)).split()[-1])
+
+            query = '''INSERT INTO global_name_changes(id, name, changed_at)
+                       SELECT r.id, r.global_name, $1 FROM roster_names r
+                       WHERE NOT EXISTS (
+                           SELECT 1 FROM global_name_changes g
+                           WHERE g.id = r.id AND g.name IS NOT DISTINCT FROM r.global_name
+                       );'''
+            new_global_name = int((await con.execute(query, now)).split()[-1])
+        self.known_names.update(u.id for u in users)
 
         print(f'Added {new_name} users\' names')
         print(f'Added {new_global_name} users\' global names')
 
-        query = '''SELECT DISTINCT id FROM name_changes'''
-        records = await self.bot.pool.fetch(query)
-        data = {record['id'] for record in records}
-        new = 0
-        for user in self.bot.users:
-            if user.id not in data:
-                await self.log_username(user)
-                new += 1
-        print(f'Added {new} users\' names')
-
     @commands.Cog.listener()
     async def on_member_join(self, member):
         query = '''INSERT INTO first_join(guild, "user", time)
@@ -123,122 +609,80 @@ class Tracker(commands.Cog):
         except UniqueViolationError:
             pass
 
-        username_check = '''SELECT * FROM name_changes WHERE id = $1 LIMIT 1;'''
-        record = await self.bot.pool.fetchrow(username_check, member.id)
-        if record is None:
-            await self.log_username(member)
-            await self.log_global_name(member)
+        if not await self.has_history(self.known_names, 'name_changes', member.id):
+            self.log_username(member)
+            self.log_global_name(member)
 
-        avatar_check = '''SELECT * FROM avatar_changes WHERE id = $1 LIMIT 1;'''
-        record = await self.bot.pool.fetchrow(avatar_check, member.id)
-        if record is None:
-            await self.log_avatar(member)
+        if not await self.has_history(self.known_avatars, 'avatar_changes', member.id):
+            await self.queue_avatar(member)
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
-        existing_ava = '''SELECT DISTINCT id FROM avatar_changes;'''
-        records = await self.bot.pool.fetch(existing_ava)
-        ava_ids = {record['id'] for record in records}
+        await self.reconcile_join_dates(guild.members)
+        if self.known_avatars.loaded:
+            ava_ids = self.known_avatars
+        else:
+            records = await self.bot.pool.fetch('''SELECT DISTINCT id FROM avatar_changes;''')
+            ava_ids = {record['id'] for record in records}
 
         for member in guild.members:
-            query = '''INSERT INTO first_join(guild, "user", time)
-                   VALUES($1, $2, $3);'''
-            join_time = make_naive(member.joined_at or discord.utils.utcnow())
-            try:
-                await self.bot.pool.execute(query, member.guild.id, member.id, join_time)
-            except asyncpg.UniqueViolationError:
-                pass
-            except Exception:
-                traceback.print_exc()
             if member.id not in ava_ids:
-                await self.log_avatar(member)
-                await asyncio.sleep(2)
+                await self.queue_avatar(member)
 
     @commands.Cog.listener()
     async def on_member_update(self, before: discord.Member, after: discord.Member):
         if before.nick != after.nick and after.nick is not None:
-            await self.log_nickname(after)
+            self.log_nickname(after)
 
     @commands.Cog.listener()
     async def on_user_update(self, before: discord.User, after: discord.User):
         if before.name != after.name or before.discriminator != after.discriminator:
-            await self.log_username(after)
+            self.log_username(after)
         if before.global_name != after.global_name:
-            await self.log_global_name(after)
+            self.log_global_name(after)
         if before.avatar != after.avatar:
-            await asyncio.sleep(2)
-            for i in range(3):
-                try:
-                    await self.log_avatar(after)
-                except (discord.HTTPException, aiohttp.ClientPayloadError):
-                    if i == 2:
-                        raise
-                    await asyncio.sleep(30)
-                else:
-                    break
-
-    async def log_nickname(self, member: discord.Member):
-        query = '''INSERT INTO nick_changes(id, guild, name, changed_at)
-                   VALUES($1, $2, $3, $4);'''
-        await self.bot.pool.execute(query, member.id, member.guild.id, member.nick, datetime.utcnow())
-
-    async def log_username(self, user: discord.User):
-        if user.discriminator == '0':
-            query = '''INSERT INTO name_changes(id, name, changed_at)
-                     VALUES($1, $2, $3);'''
-            await self.bot.pool.execute(query, user.id, user.name, datetime.utcnow())
-        else:
-            query = '''INSERT INTO name_changes(id, name, discrim, changed_at)
-                       VALUES($1, $2, $3, $4);'''
-            await self.bot.pool.execute(query, user.id, user.name, user.discriminator, datetime.utcnow())
+            await self.queue_avatar(after)
+
+    # These are written out in batches by the history writer, so the gateway handlers never wait on the database
+    def log_nickname(self, member: discord.Member):
+        self.history.add('nick_changes', (member.id, member.guild.id, member.nick, datetime.utcnow()))
 
+    def log_username(self, user: discord.User):
+        discrim = None if user.discriminator == '0' else user.discriminator
+        self.known_names.add(user.id)
+        self.history.add('name_changes', (user.id, user.name, discrim, datetime.utcnow()))
 
-    async def log_global_name(self, user: discord.User):
-        query = '''INSERT INTO global_name_changes(id, name, changed_at)
-                VALUES($1, $2, $3);'''
-        await self.bot.pool.execute(query, user.id, user.global_name, datetime.utcnow())
+    def log_global_name(self, user: discord.User):
+        self.history.add('global_name_changes', (user.id, user.global_name, datetime.utcnow()))
 
 
-    async def log_avatar(self, user: discord.User):
+    async def queue_avatar(self, user: discord.User):
+        """Logs the user's avatar without waiting for it to be archived, only waits while the queue is full"""
+        self.known_avatars.add(user.id)
         if user.avatar:
-            _hash = user.avatar.key
-            _type = 'gif' if _hash.startswith('a_') else 'png'
-            try:
-                file = discord.File(BytesIO(await user.avatar.with_static_format('png').read()),
-                                    filename=f'{_hash}.{_type}')
-            except discord.HTTPException:
-                try:
-                    file = discord.File(BytesIO(await user.avatar.with_format('png').read()),
-                                        filename=f'{_hash}.png')
-                except discord.HTTPException:
-                    logger.warning(f'Failed to get avatar for {user} ({user.id}) | {user.avatar.url}')
-                    return
-
-            wh = discord.utils.get(await self.bot.get_guild(557306479191916555).webhooks(),
-                                   channel_id=703171905435467956)
-            if wh is not None:
-                try:
-                    msg = await wh.send(content=user.id, file=file, wait=True, username=_hash)
-                except discord.HTTPException as e:
-                    if 'Payload Too Large' in str(e):
-                        file = discord.File(BytesIO(await user.avatar.with_format('png').read()),
-                                            filename=f'{_hash}.png')
-                        msg = await wh.send(content=user.id, file=file, wait=True, username=_hash)
-            else:
-                self.bot.get_channel(703171905435467956)
-                msg = await self.bot.get_channel(703171905435467956).send(content=user.id, file=file)
-            url = msg.attachments[0].url
-            message_id = msg.id
+            await self.archiver.enqueue(user)
         else:
-            _hash = self._default_avatar_names.get(int(user.display_avatar.key))
-            if _hash is None:
-                print(f'Unknown default avatar: {user.avatar.key} | {user.avatar}')
-                return
-            url = user.default_avatar.url
-            message_id = None
-        query = '''INSERT INTO avatar_changes(id, hash, url, message, changed_at)
-                   VALUES($1, $2, $3, $4, $5);'''
-        await self.bot.pool.execute(query, user.id, _hash, url, message_id, datetime.utcnow())
+            self.log_default_avatar(user)
+
+    async def log_avatar(self, user: discord.User, *, timeout=60):
+        """Logs the user's avatar and returns the archived url, or None if that takes longer than the timeout"""
+        self.known_avatars.add(user.id)
+        if not user.avatar:
+            return self.log_default_avatar(user)
+        try:
+            # Shielded so giving up here doesn't cancel it for everyone else waiting
+            return await asyncio.wait_for(asyncio.shield(self.archiver.request(user)), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def log_default_avatar(self, user: discord.User):
+        # Nothing to upload, so these go out in batches with the rest of the history
+        _hash = self._default_avatar_names.get(int(user.display_avatar.key))
+        if _hash is None:
+            print(f'Unknown default avatar: {user.display_avatar.key} | {user.display_avatar}')
+            return
+        url = user.default_avatar.url
+        self.history.add('avatar_changes', (user.id, _hash, url, None, datetime.utcnow()))
         return url
 
     @commands.Cog.listener()
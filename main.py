@@ -15,6 +15,7 @@ import asyncpg
 import discord
 from discord.ext import commands
 
+from utils import metrics
 from utils.context import Context
 from config import BOT_TOKEN, DBURI
 
@@ -110,6 +111,7 @@ class SnowflakeBot(commands.Bot):
     prefixes: dict[int, List[str]]
     session: aiohttp.ClientSession
     mb_client: mystbin.Client
+    metrics_server: Optional[aiohttp.web.AppRunner]
 
     def __init__(self) -> None:
         super().__init__(command_prefix=get_prefix,
@@ -121,6 +123,7 @@ class SnowflakeBot(commands.Bot):
                          intents=discord.Intents.all())
 
         self.starttime = discord.utils.utcnow()
+        self.metrics_server = None
 
     async def setup_hook(self) -> None:
         self.prefixes = await self.fetch_prefixes()
@@ -129,6 +132,15 @@ class SnowflakeBot(commands.Bot):
         app_info = await self.application_info()
         self.owner_id = app_info.owner.id
 
+        port = getattr(self.config, 'METRICS_PORT', None)
+        if port is not None:
+            self.metrics_server = await metrics.start_server(port)
+
+    async def close(self) -> None:
+        if self.metrics_server is not None:
+            await self.metrics_server.cleanup()
+        await super().close()
+
     @property
     def owner(self) -> discord.User | None:
         return self.get_user(self.owner_id)
@@ -0,0 +1,11 @@
+-- Timers were only filterable by author through extra #>> '{args,0}', which
+-- can't use an index. Store the author in its own column instead.
+
+ALTER TABLE timers ADD COLUMN IF NOT EXISTS author_id BIGINT;
+
+UPDATE timers
+SET author_id = (extra #>> '{args,0}')::BIGINT
+WHERE author_id IS NULL
+AND extra #>> '{args,0}' ~ '^[0-9]+$';
+
+CREATE INDEX IF NOT EXISTS timers_event_author_id_expires_idx ON timers (event, author_id, expires);
@@ -0,0 +1,12 @@
+-- Avatars are archived once per distinct image, keyed by the SHA-256 of the
+-- uploaded bytes, so switching back to an old avatar reuses the archived copy.
+
+CREATE TABLE IF NOT EXISTS avatar_archive (
+    content_hash BYTEA PRIMARY KEY,
+    url TEXT NOT NULL,
+    message BIGINT,
+    archived_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'utc')
+);
+
+-- Looked up before downloading, an avatar hash that was archived already needs no upload either
+CREATE INDEX IF NOT EXISTS avatar_changes_hash_idx ON avatar_changes (hash);
@@ -12,8 +12,9 @@ import asyncio
 import enum
 import time
 
+from collections import OrderedDict
 from functools import wraps
-from typing import Any, Callable, Coroutine, MutableMapping, TypeVar, Protocol
+from typing import Any, Callable, Coroutine, MutableMapping, Optional, TypeVar, Protocol
 
 from lru import LRU
 
@@ -39,17 +40,24 @@ class CacheProtocol(Protocol[R]):
         ...
 
 
-class ExpiringCache(dict):
-    def __init__(self, seconds: float):
+class ExpiringCache(OrderedDict):
+    # Every entry shares the same TTL, so insertion order is also expiry order
+    # and only the oldest entries ever need to be checked.
+    def __init__(self, seconds: float, maxsize: Optional[int] = None):
         self.__ttl: float = seconds
+        self.__maxsize: Optional[int] = maxsize
+        self.__hits: int = 0
+        self.__misses: int = 0
         super().__init__()
 
     def __verify_cache_integrity(self):
-        # Have to do this in two steps...
         current_time = time.monotonic()
-        to_remove = [k for (k, (v, t)) in super().items() if current_time > (t + self.__ttl)]
-        for k in to_remove:
-            del self[k]
+        while self:
+            k = next(iter(self))
+            _, t = super().__getitem__(k)
+            if current_time <= (t + self.__ttl):
+                break
+            super().__delitem__(k)
 
     def __contains__(self, key: str):
         self.__verify_cache_integrity()
@@ -57,24 +65,41 @@ class ExpiringCache(dict):
 
     def __getitem__(self, key: str):
         self.__verify_cache_integrity()
-        v, _ = super().__getitem__(key)
+        try:
+            v, _ = super().__getitem__(key)
+        except KeyError:
+            self.__misses += 1
+            raise
+        self.__hits += 1
         return v
 
     def get(self, key: str, default: Any = None):
+        self.__verify_cache_integrity()
         v = super().get(key, default)
         if v is default:
+            self.__misses += 1
             return default
+        self.__hits += 1
         return v[0]
 
     def __setitem__(self, key: str, value: Any):
         super().__setitem__(key, (value, time.monotonic()))
+        self.move_to_end(key)
+        if self.__maxsize is not None and len(self) > self.__maxsize:
+            # Spill the least recently set entry
+            self.popitem(last=False)
 
     def values(self):
+        self.__verify_cache_integrity()
         return map(lambda x: x[0], super().values())
 
     def items(self):
+        self.__verify_cache_integrity()
         return map(lambda x: (x[0], x[1][0]), super().items())
 
+    def get_stats(self) -> tuple[int, int]:
+        return self.__hits, self.__misses
+
 
 class Strategy(enum.Enum):
     lru = 1
@@ -96,7 +121,7 @@ def cache(
             _stats = lambda: (0, 0)
         elif strategy is Strategy.timed:
             _internal_cache = ExpiringCache(maxsize)
-            _stats = lambda: (0, 0)
+            _stats = _internal_cache.get_stats
 
         def _make_key(args: tuple[Any, ...], kwargs: dict[str, Any]) -> str:
             # this is a bit of a cluster fuck
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import bisect
+import logging
+from typing import Optional, Sequence
+
+from aiohttp import web
+
+
+log = logging.getLogger(__name__)
+
+# Seconds, good enough for anything from a database round trip to a late timer
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Histogram:
+    """A fixed bucket histogram, rendered in the Prometheus text format"""
+
+    def __init__(self, name: str, description: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name: str = name
+        self.description: str = description
+        self.buckets: tuple[float, ...] = tuple(sorted(buckets))
+        # The last count is for values above every bucket
+        self.counts: list[int] = [0] * (len(self.buckets) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.max: float = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """Estimates a quantile as the upper bound of the bucket it falls in"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {seen}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+        return '\n'.join(lines)
+
+
+# Kept at module level so reloading a cog keeps its metrics
+_registry: dict[str, Histogram] = {}
+
+
+def histogram(name: str, description: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    """Gets a registered histogram, creating it if it does not exist yet"""
+    try:
+        return _registry[name]
+    except KeyError:
+        hist = _registry[name] = Histogram(name, description, buckets)
+        return hist
+
+
+def render() -> str:
+    return '\n'.join(hist.render() for hist in _registry.values()) + '\n'
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type='text/plain')
+
+
+async def start_server(port: int, host: str = '127.0.0.1') -> Optional[web.AppRunner]:
+    """Serves every registered metric on /metrics, only on localhost by default"""
+    app = web.Application()
+    app.router.add_get('/metrics', _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError:
+        log.exception('Could not start the metrics server on %s:%s', host, port)
+        await runner.cleanup()
+        return None
+    log.info('Serving metrics on %s:%s', host, port)
+    return runner
@@ -10,12 +10,14 @@ from __future__ import annotations
 
 import re
 import datetime
+import functools
 from typing import TYPE_CHECKING, Any, Optional, Union
 
 import parsedatetime as pdt
 from dateutil.relativedelta import relativedelta
 from discord.ext import commands
 from discord import app_commands
+from lru import LRU
 
 from utils.formats import plural, human_join, format_dt as format_dt
 from utils.errors import TimezoneRequired
@@ -25,6 +27,132 @@ units = pdt.pdtLocales['en_US'].units
 units['minutes'].append('mins')
 units['seconds'].append('secs')
 
+
+# Words parsedatetime joins onto a neighbouring date phrase, e.g. "in 3 days at 5pm" is one phrase
+_locale = pdt.pdtLocales['en_US']
+_DATE_WORDS = frozenset(
+    word
+    for group in (
+        _locale.Weekdays,
+        _locale.shortWeekdays,
+        _locale.Months,
+        _locale.shortMonths,
+        _locale.dayOffsets,
+        _locale.re_sources,
+        _locale.Modifiers,
+        _locale.numbers,
+        *_locale.units.values(),
+        ('am', 'pm', 'a.m.', 'p.m.'),
+    )
+    for words in group
+    for word in re.split(r'[|\s]', words)
+)
+_WORD_SPLIT = re.compile(r'[\s,.!?;:]+')
+
+_FAST_RELATIVE = re.compile(r'in (?P<amount>[0-9]{1,4}) (?P<unit>minutes?|mins?|hours?|days?|weeks?)', re.IGNORECASE)
+_FAST_TOMORROW_AT = re.compile(
+    r'tomorrow at (?P<hour>1[0-2]|[1-9])(?::(?P<minute>[0-5][0-9]))? ?(?P<meridian>am|pm)', re.IGNORECASE
+)
+_FAST_NEXT_WEEKDAY = re.compile(r'next (?P<weekday>monday|tuesday|wednesday|thursday|friday|saturday|sunday)', re.IGNORECASE)
+_FAST_ISO_DATE = re.compile(r'(?P<year>[0-9]{4})-(?P<month>[0-9]{2})-(?P<day>[0-9]{2})')
+
+_RELATIVE_UNITS = {
+    'min': ('minutes', pdt.pdtContext.ACU_MIN),
+    'hou': ('hours', pdt.pdtContext.ACU_HOUR),
+    'day': ('days', pdt.pdtContext.ACU_DAY),
+    'wee': ('weeks', pdt.pdtContext.ACU_WEEK),
+}
+_WEEKDAYS = {name: index for index, name in enumerate(_locale.Weekdays)}
+
+# (text, tz, minute): (elements, naive source time they were parsed against)
+_nlp_cache: LRU = LRU(512)
+
+
+def _ends_phrase(argument: str, end: int) -> bool:
+    """Whether parsedatetime would stop the date phrase at this index.
+
+    It joins date words even across unrelated words, so the rest of the argument has to be free of them.
+    """
+    for word in _WORD_SPLIT.split(argument[end:].lower()):
+        if word and (not word.isalpha() or word in _DATE_WORDS):
+            return False
+    return True
+
+
+def _fast_nlp(argument: str, now: datetime.datetime) -> Optional[list[tuple[Any, ...]]]:
+    """Parses the most common phrasings at the start of the argument the same way parsedatetime's nlp does"""
+    # parsedatetime works on the wall time, at second resolution
+    source = now.replace(tzinfo=None, microsecond=0)
+
+    match = _FAST_RELATIVE.match(argument)
+    if match is not None and _ends_phrase(argument, match.end()):
+        unit, accuracy = _RELATIVE_UNITS[match.group('unit')[:3].lower()]
+        dt = source + datetime.timedelta(**{unit: int(match.group('amount'))})
+        return [(dt, pdt.pdtContext(accuracy), 0, match.end(), match.group(0))]
+
+    match = _FAST_TOMORROW_AT.match(argument)
+    if match is not None and _ends_phrase(argument, match.end()):
+        hour = int(match.group('hour')) % 12
+        if match.group('meridian').lower() == 'pm':
+            hour += 12
+        accuracy = pdt.pdtContext.ACU_DAY | pdt.pdtContext.ACU_HOUR
+        if match.group('minute') is not None:
+            accuracy |= pdt.pdtContext.ACU_MIN
+        tomorrow = source.date() + datetime.timedelta(days=1)
+        dt = datetime.datetime.combine(tomorrow, datetime.time(hour, int(match.group('minute') or 0)))
+        return [(dt, pdt.pdtContext(accuracy), 0, match.end(), match.group(0))]
+
+    match = _FAST_NEXT_WEEKDAY.match(argument)
+    if match is not None and _ends_phrase(argument, match.end()):
+        # "next" is the day in the following week, unless that day of this week has already passed
+        weekday = _WEEKDAYS[match.group('weekday').lower()]
+        days = (weekday - source.weekday()) % 7 + (7 if weekday > source.weekday() else 0) or 7
+        day = source.date() + datetime.timedelta(days=days)
+        dt = datetime.datetime.combine(day, datetime.time(HumanTime.calendar.ptc.StartHour))
+        return [(dt, pdt.pdtContext(pdt.pdtContext.ACU_DAY), 0, match.end(), match.group(0))]
+
+    match = _FAST_ISO_DATE.match(argument)
+    if match is not None and _ends_phrase(argument, match.end()):
+        try:
+            dt = source.replace(year=int(match.group('year')), month=int(match.group('month')), day=int(match.group('day')))
+        except ValueError:
+            return None
+        accuracy = pdt.pdtContext.ACU_YEAR | pdt.pdtContext.ACU_MONTH | pdt.pdtContext.ACU_DAY
+        return [(dt, pdt.pdtContext(accuracy), 0, match.end(), match.group(0))]
+
+    return None
+
+
+def parse_natural_time(argument: str, now: datetime.datetime) -> Optional[list[tuple[Any, ...]]]:
+    """Same as parsedatetime's Calendar.nlp, with the common phrasings parsed by regex and the rest cached.
+
+    The cache is keyed to the minute. Results that were relative to the source time are moved by
+    the seconds between the cached source time and this one, everything else is reused as is.
+    """
+    elements = _fast_nlp(argument, now)
+    if elements is not None:
+        return elements
+
+    source = now.replace(tzinfo=None, microsecond=0)
+    # Lowercasing is only safe when it keeps the string the same length, the indexes point into the argument
+    key = (argument.lower() if argument.isascii() else argument, str(now.tzinfo), source.replace(second=0))
+    cached = _nlp_cache.get(key)
+    if cached is not None:
+        elements, cached_source = cached
+        if not elements or cached_source == source:
+            return elements
+        shift = source - cached_source
+        return [
+            (dt + shift if dt.second == cached_source.second else dt, *rest)
+            for dt, *rest in elements
+        ]
+
+    elements = HumanTime.calendar.nlp(argument, sourceTime=now)
+    # At zero seconds, a relative result can't be told apart from an absolute one
+    if source.second != 0:
+        _nlp_cache[key] = (elements and tuple(elements), source)
+    return elements
+
 if TYPE_CHECKING:
     from typing_extensions import Self
     from utils.context import Context
@@ -241,7 +369,6 @@ class UserFriendlyTime(commands.Converter):
         self.default: Any = default
 
     async def convert(self, ctx: Context, argument: str) -> FriendlyTimeResult:
-        calendar = HumanTime.calendar
         regex = ShortTime.compiled
         now = ctx.message.created_at
 
@@ -284,7 +411,7 @@ class UserFriendlyTime(commands.Converter):
 
         # Have to adjust the timezone so pdt knows how to handle things like "tomorrow at 6pm" in an aware way
         now = now.astimezone(tzinfo)
-        elements = calendar.nlp(argument, sourceTime=now)
+        elements = parse_natural_time(argument, now)
         if elements is None or len(elements) == 0:
             raise commands.BadArgument('Invalid time provided, try e.g. "tomorrow" or "3 days".')
 
@@ -342,6 +469,50 @@ class UserFriendlyTime(commands.Converter):
         return result
 
 
+# Below 28 days relativedelta never counts a month, so the output only depends on the seconds between the two
+_FAST_DELTA_LIMIT = 28 * 86400
+
+
+@functools.lru_cache(maxsize=4096)
+def _human_seconds(seconds: int, accuracy: Optional[int], brief: bool, suffix: bool) -> str:
+    """The same output as _human_relativedelta for deltas under _FAST_DELTA_LIMIT, from integer arithmetic"""
+    output_suffix = ''
+    if seconds <= 0:
+        seconds = -seconds
+        output_suffix = ' ago' if suffix else ''
+
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    weeks, days = divmod(days, 7)
+
+    output = []
+    for elem, attr, brief_attr in (
+        (weeks, 'week', 'w'),
+        (days, 'day', 'd'),
+        (hours, 'hour', 'h'),
+        (minutes, 'minute', 'm'),
+        (seconds, 'second', 's'),
+    ):
+        if not elem:
+            continue
+        if brief:
+            output.append(f'{elem}{brief_attr}')
+        else:
+            output.append(f'{elem} {attr}' if elem == 1 else f'{elem} {attr}s')
+
+    if accuracy is not None:
+        output = output[:accuracy]
+
+    if len(output) == 0:
+        return 'now'
+    else:
+        if not brief:
+            return human_join(output, final='and') + output_suffix
+        else:
+            return ' '.join(output) + output_suffix
+
+
 def human_timedelta(
     dt: datetime.datetime,
     *,
@@ -361,10 +532,27 @@ def human_timedelta(
     now = now.replace(microsecond=0)
     dt = dt.replace(microsecond=0)
 
+    delta = dt - now
+    if dt.tzinfo is now.tzinfo and not isinstance(now.tzinfo, datetime.timezone):
+        # Subtracting with the same tzinfo ignores any DST change in between
+        delta = dt.astimezone(datetime.timezone.utc) - now.astimezone(datetime.timezone.utc)
+    seconds = delta.days * 86400 + delta.seconds
+    if -_FAST_DELTA_LIMIT < seconds < _FAST_DELTA_LIMIT:
+        return _human_seconds(seconds, accuracy, brief, suffix)
+
     # Make sure they're both in the timezone
     now = now.astimezone(datetime.timezone.utc)
     dt = dt.astimezone(datetime.timezone.utc)
+    return _human_relativedelta(dt, now, accuracy, brief, suffix)
 
+
+def _human_relativedelta(
+    dt: datetime.datetime,
+    now: datetime.datetime,
+    accuracy: Optional[int],
+    brief: bool,
+    suffix: bool,
+) -> str:
     # This implementation uses relativedelta instead of the much more obvious
     # divmod approach with seconds because the seconds approach is not entirely
     # accurate once you go over 1 week in terms of accuracy since you have to
@@ -420,5 +608,6 @@ def human_timedelta(
         else:
             return ' '.join(output) + output_suffix
 
+
 def format_relative(dt: datetime.datetime) -> str:
     return format_dt(dt, 'R')